@@ -1 +1,5 @@
 from .baseutils import *  # noqa
+try:
+    from .aio import *  # noqa
+except SyntaxError:
+    pass  # the asyncio helpers require Python 3.5 or later
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import signal
+import subprocess
+
+from .baseutils import (CommandStream, DEFAULT_READ_SIZE, KILL_GRACE_PERIOD, OutputCapture, _kill_listed_processes, _listed_processes, _output_decoder,
+                        _process_tree, _register_children, _signal_processes, _stdin_chunks, _stdin_file, _unregister_children)
+
+
+async def exe_cmd_async(cmd, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False,
+                        output_log_limit=None, capture=None, read_size=DEFAULT_READ_SIZE, log_tag=None, limit=None, redact=None):
+    """
+    asyncio counterpart of exe_cmd. Many commands can be run concurrently from one event loop without a thread per command.
+    Args:
+        cmd: The command to execute. A string is run by the shell, a list of arguments is executed directly. See exe_cmd
+        working_dir: The directory to execute the command from (Optional)
+        obfuscate: A value to obfuscate in the logging (Optional)
+        stdin: The standard input for the process: a string, bytes, a file object or an iterable of chunks. See exe_cmd (Optional)
+        env: Custom environment variables to be used in place of parent environment variables (Optional, default: parent process environment variables)
+        log_level: The default logging level. Default: INFO. Setting to None will disable logging in this function
+        raise_exception: Whether to raise an exception if the command returns a non-zero return code (Default: True)
+        stream_log: When True, the process output will be logged as it arrives (Default: False)
+        output_log_limit: See exe_cmd (Optional)
+        capture: See exe_cmd (Optional)
+        read_size: The maximum number of bytes of output to read at a time. Output is decoded as UTF-8, replacing invalid bytes (Default: DEFAULT_READ_SIZE)
+        log_tag: A tag to prefix all log lines for this command with (Optional)
+        limit: An asyncio.Semaphore to acquire before starting the command, to limit how many commands run at once (Optional)
+        redact: A Redactor whose secrets are masked in the logged command and the output. See exe_cmd (Optional)
+    Returns: A tuple of the return code and the output. If the coroutine is cancelled, eg. by asyncio.wait_for, the command is terminated
+    Example:
+        (rc, output) = await exe_cmd_async('kubectl get nodes')
+    """
+    stream = CommandStream(cmd, working_dir=working_dir, obfuscate=obfuscate, stdin=stdin, env=env, log_level=log_level, raise_exception=raise_exception,
+                           stream_log=stream_log, read_size=read_size, capture=capture or OutputCapture(), log_output=not stream_log, output_log_limit=output_log_limit,
+                           log_tag=log_tag, redact=redact)
+    if limit:
+        async with limit:
+            await _run_stream(stream)
+    else:
+        await _run_stream(stream)
+    return (stream.rc, stream.output)
+
+
+async def exe_cmds_async(cmds, max_concurrency=None, return_exceptions=False, **kwargs):
+    """
+    Runs several commands concurrently with exe_cmd_async.
+    Args:
+        cmds: The commands to execute
+        max_concurrency: The maximum number of commands to run at once (Optional, default: no limit)
+        return_exceptions: Set True to return the exception raised for a failing command in its place in the results, rather than raising it (Default: False)
+        **kwargs: Any other arguments are passed to exe_cmd_async for every command
+    Returns: A list of the (rc, output) tuples of the commands, in the order of cmds
+    Example:
+        results = asyncio.run(exe_cmds_async(['kubectl --context {c} get nodes'.format(c=c) for c in clusters], max_concurrency=50))
+    """
+    limit = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    return await asyncio.gather(*[exe_cmd_async(cmd, limit=limit, **kwargs) for cmd in cmds], return_exceptions=return_exceptions)
+
+
+async def _run_stream(stream):
+    """
+    Runs the command of a CommandStream as an asyncio subprocess, feeding the output to the stream and finishing it.
+    Args:
+        stream: The CommandStream holding the command and its options
+    """
+    stream._log_start()
+    kwargs = {'stdin': _stdin_file(stream.stdin) or (subprocess.PIPE if stream.stdin else None), 'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT,
+              'cwd': stream.working_dir, 'env': stream.env}
+    if isinstance(stream.cmd, (list, tuple)):
+        p = await asyncio.create_subprocess_exec(*stream.cmd, **kwargs)
+    else:
+        p = await asyncio.create_subprocess_shell(stream.cmd, **kwargs)
+    _register_children(p, stream.obfus_cmd)
+    stdin_writer = asyncio.ensure_future(_write_stdin(p, stream.stdin)) if p.stdin else None
+    decoder = _output_decoder()
+    try:
+        while True:
+            data = await p.stdout.read(stream.read_size)
+            stream._feed_output(decoder.decode(data, final=not data), final=not data)
+            if not data:
+                break
+    except BaseException:
+        if stdin_writer:
+            stdin_writer.cancel()
+            await asyncio.wait([stdin_writer])
+            stdin_writer = None
+        await _terminate_process(p)
+        raise
+    finally:
+        try:
+            if stdin_writer:
+                await asyncio.wait([stdin_writer])
+            stream.rc = await p.wait()
+        finally:
+            _unregister_children(p)
+    if stdin_writer:
+        stream._stdin_error = stdin_writer.exception()
+    stream._finish()
+
+
+async def _terminate_process(p, grace_period=KILL_GRACE_PERIOD):
+    """
+    Terminates a command that is no longer being read, along with the processes it started, killing them if still running after the grace period.
+    """
+    descendants = _listed_processes(_process_tree(p.pid)[1:])
+    try:
+        p.terminate()
+    except ProcessLookupError:
+        pass  # the command has exited
+    _signal_processes([pid for (pid, _) in descendants], signal.SIGTERM)
+    try:
+        await asyncio.wait_for(p.wait(), grace_period)
+    except asyncio.TimeoutError:
+        p.kill()
+    _kill_listed_processes(descendants)
+
+
+async def _write_stdin(p, data):
+    """
+    Writes the standard input of an asyncio subprocess and closes it.
+    If reading or writing the input fails, other than because the command exited, the command is terminated before the pipe is closed and the error is raised.
+    Args:
+        p: The asyncio subprocess
+        data: The standard input. Chunks are read from a file object in the default executor, and from an iterable in the event loop's thread
+    """
+    pipe = p.stdin
+    loop = asyncio.get_event_loop()
+    chunks = _stdin_chunks(data)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None) if hasattr(data, 'read') else next(chunks, None)
+            if chunk is None:
+                break
+            pipe.write(chunk)
+            await pipe.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # the command exited without reading all of its input
+    except Exception:
+        if p.returncode is None:
+            _signal_processes(_process_tree(p.pid), signal.SIGTERM)  # the command must not run on incomplete input
+        raise
+    finally:
+        pipe.close()
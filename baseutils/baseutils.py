@@ -1,13 +1,33 @@
+import atexit
+import binascii
+import codecs
+import collections
+import ctypes
+import contextlib
+import datetime
+import errno
+import functools
+import gzip
+import hashlib
+import io
 import json
 import logging
+import logging.handlers
 import logmatic
 import os
+import pickle
+import platform
+import re
 import sys
 import requests
+import shutil
 import signal
 import smtplib
+import socket
+import struct
 import subprocess
 import tempfile
+import threading
 import time
 try:  # python3
     from email.mime.multipart import MIMEMultipart
@@ -15,6 +35,32 @@ try:  # python3
 except ImportError:
     from email.MIMEMultipart import MIMEMultipart
     from email.MIMEText import MIMEText
+try:  # python3
+    import queue
+    import socketserver
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+try:
+    import selectors
+except ImportError:
+    pass  # selectors requires python3. The split_stderr option of exe_cmd will not work without it
+try:
+    import concurrent.futures
+except ImportError:
+    pass  # concurrent.futures requires the futures package on python2. The exe_cmds function will not work without it
+try:  # python3
+    from shlex import quote as _shell_quote
+except ImportError:
+    from pipes import quote as _shell_quote
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson is optional. JsonFormatter falls back to the json module without it
+try:
+    import resource
+except ImportError:
+    pass  # resource is not available on Windows. Resource limits for commands will not work there
 try:
     import fcntl
 except ImportError:
@@ -22,6 +68,27 @@ except ImportError:
 
 
 logger = logging.getLogger(__name__)
+DEFAULT_READ_SIZE = 65536
+ITER_CMD_ERROR_LINES = 20
+ITER_CMD_ERROR_SIZE = 10000
+KILL_GRACE_PERIOD = 10
+_monotonic = getattr(time, 'monotonic', time.time)
+_LOG_AGGREGATORS_ENV = 'BASEUTILS_LOG_AGGREGATORS'
+_queue_listeners = None  # the running QueueListeners of async_logging, once the atexit hook stopping them is registered
+_queue_listeners_lock = threading.Lock()
+_spawn_server = None
+_spawn_server_lock = threading.Lock()
+_RECORD_COMMANDS_ENV = 'BASEUTILS_RECORD_COMMANDS'
+_REPLAY_COMMANDS_ENV = 'BASEUTILS_REPLAY_COMMANDS'
+_command_fixture = None
+_env_command_fixtures = {}
+_command_fixtures_lock = threading.Lock()
+_running_children = {}
+_running_children_lock = threading.RLock()  # reentrant as the signal handler of install_child_cleanup may interrupt the main thread holding it
+_child_cleanup_grace_period = None
+_exception_formatter = logging.Formatter()
+_IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+_IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
 
 
 def assert_linux():
@@ -33,7 +100,8 @@ def assert_linux():
         raise Exception('This function currently does not support Windows')
 
 
-def configure_logger(custom_logger, file_path=None, stream=False, formatter=None, json_formatter=False, level=logging.INFO):
+def configure_logger(custom_logger, file_path=None, stream=False, formatter=None, json_formatter=False, level=logging.INFO, async_logging=False,
+                     max_total_bytes=None, shared=False):
     """
     Configure a logger in a standard way for python applications.
     Args:
@@ -43,16 +111,139 @@ def configure_logger(custom_logger, file_path=None, stream=False, formatter=None
         formatter: A custom formatter to use. If not provided, standard formatter will be created. See arg json_formatter for details (Optional)
         json_formatter: If a formatter is not provided, this identifies if the formatter that will be created should be a json formatter (logmatics) or a standard formatter
         level: The log level to configure (Optional, default: logging.INFO)
+        async_logging: Set True to have the logger enqueue records and let a background thread format and write them.
+            The queue is drained when the interpreter exits. See get_logger_queue_depth to monitor the backlog. Python 3 only (Default: False)
+        max_total_bytes: If set, rotated log files are gzipped in the background and the oldest are deleted to keep the log file and its backups
+            under this many bytes, in place of keeping 10 uncompressed backups. See CompressingRotatingFileHandler (Optional)
+        shared: Set True when worker processes log to the same file_path. The first process to configure the file starts a LogAggregator that owns the file.
+            Child processes (forked or started with this environment) that then configure the same file_path send their records to it over a socket
+            instead of writing and rotating the file themselves. Linux and Python 3 only (Default: False)
     """
+    handlers = []
     if file_path:
-        handler = logging.handlers.RotatingFileHandler(file_path, backupCount=10, maxBytes=52428800)
+        handler = _create_file_handler(custom_logger, file_path, max_total_bytes=max_total_bytes, shared=shared)
         _add_logger_handler(custom_logger, handler, formatter)
+        handlers.append(handler)
     if stream:
         handler = logging.StreamHandler()
         _add_logger_handler(custom_logger, handler, formatter, json_formatter=json_formatter)
+        handlers.append(handler)
+    if async_logging and handlers:
+        _queue_logger_handlers(custom_logger, handlers)
     custom_logger.setLevel(level)
 
 
+def _create_file_handler(custom_logger, file_path, max_total_bytes=None, shared=False):
+    """
+    Create the handler for configure_logger's file logging.
+    Args:
+        custom_logger: The logger being configured
+        file_path: The path to the log file
+        max_total_bytes: If set, a CompressingRotatingFileHandler with this budget is created (Optional)
+        shared: Whether the file is shared with other processes through a LogAggregator (Default: False)
+    Returns: The handler
+    """
+    file_path = os.path.abspath(file_path)
+    aggregator_address = _get_log_aggregator_address(file_path) if shared else None
+    if aggregator_address:
+        for handler in list(custom_logger.handlers):
+            if _handler_writes_file(handler, file_path):
+                custom_logger.removeHandler(handler)  # inherited from the parent process on fork
+        return logging.handlers.SocketHandler(aggregator_address, None)
+    if max_total_bytes:
+        handler = CompressingRotatingFileHandler(file_path, maxBytes=52428800, max_total_bytes=max_total_bytes)
+    else:
+        handler = SizeRotatingFileHandler(file_path, backupCount=10, maxBytes=52428800)
+    if shared:
+        handler.aggregator = LogAggregator(handler)
+    return handler
+
+
+def _get_log_aggregator_address(file_path):
+    """
+    Looks up the socket address of a LogAggregator that another process started for a log file.
+    Args:
+        file_path: The absolute path to the log file
+    Returns: The socket address, or None if there is no aggregator for the file or it belongs to this process
+    """
+    aggregators = json.loads(os.environ.get(_LOG_AGGREGATORS_ENV, '{}'))
+    if file_path in aggregators and aggregators[file_path]['pid'] != os.getpid():
+        return aggregators[file_path]['address']
+    return None
+
+
+def _handler_writes_file(handler, file_path):
+    """
+    Returns True if a handler, or the handlers behind it for a queued handler, write to a given file.
+    Args:
+        handler: The handler to check
+        file_path: The absolute path to the file
+    """
+    listener = getattr(handler, 'listener', None)
+    if listener:
+        return any(_handler_writes_file(queued_handler, file_path) for queued_handler in listener.handlers)
+    return getattr(handler, 'baseFilename', None) == file_path
+
+
+class LogAggregator(object):
+    """
+    Receives log records from other processes over a Unix socket and writes them through a handler owned by this process.
+    This allows several processes to share one log file with a single writer that owns the rotation.
+    The aggregator is created by configure_logger(shared=True) and is registered in the environment so child processes can find it.
+    Records are sent by logging.handlers.SocketHandler, which only pickles them, so workers do not wait on the file.
+    This class does not work on Windows.
+    """
+    def __init__(self, handler):
+        """
+        Constructor for the aggregator. The aggregator starts listening immediately and is stopped at interpreter exit.
+        Args:
+            handler: The handler that records received from other processes are written to. Its baseFilename identifies the log file to other processes
+        """
+        assert_linux()
+        self.handler = handler
+        self._pid = os.getpid()
+        self._socket_dir = tempfile.mkdtemp(prefix='baseutils-log-')
+        self.address = os.path.join(self._socket_dir, 'aggregator.sock')
+        self._server = socketserver.ThreadingUnixStreamServer(self.address, _LogRecordStreamHandler)
+        self._server.daemon_threads = True
+        self._server.log_handler = handler
+        thread = threading.Thread(target=self._server.serve_forever, name='log-aggregator')
+        thread.daemon = True
+        thread.start()
+        aggregators = json.loads(os.environ.get(_LOG_AGGREGATORS_ENV, '{}'))
+        aggregators[handler.baseFilename] = {'pid': os.getpid(), 'address': self.address}
+        os.environ[_LOG_AGGREGATORS_ENV] = json.dumps(aggregators)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops accepting records from other processes and unregisters the aggregator from the environment.
+        Does nothing in a forked child, which inherits the aggregator and its atexit hook but not its server thread.
+        """
+        if not self._server or os.getpid() != self._pid:
+            return
+        aggregators = json.loads(os.environ.get(_LOG_AGGREGATORS_ENV, '{}'))
+        aggregators.pop(self.handler.baseFilename, None)
+        os.environ[_LOG_AGGREGATORS_ENV] = json.dumps(aggregators)
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+
+class _LogRecordStreamHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the connection from one process for a LogAggregator. Reads length-prefixed pickled records as sent by logging.handlers.SocketHandler.
+    """
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                break
+            record = logging.makeLogRecord(pickle.loads(self.rfile.read(struct.unpack('>L', header)[0])))
+            self.server.log_handler.handle(record)
+
+
 def _add_logger_handler(custom_logger, handler, formatter=None, json_formatter=False):
     """
     Add a handler to a logger. If a formatter is not provided, a default logmatic one will be created.
@@ -71,14 +262,442 @@ def _add_logger_handler(custom_logger, handler, formatter=None, json_formatter=F
     custom_logger.addHandler(handler)
 
 
+class SizeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A drop-in replacement for logging.handlers.RotatingFileHandler that formats each record only once.
+    The stock handler formats every record a second time to decide whether to roll over and queries the file position per record.
+    This handler keeps a running count of the bytes written instead, seeded from the file size when the file is opened.
+    Rotation and backup naming are unchanged. As with the stock handler, a path that is not a regular file, eg. /dev/null, is not rotated.
+    It is checked again on each record until it is a regular file.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SizeRotatingFileHandler, self).__init__(*args, **kwargs)
+        self.bytes_written = None
+
+    def doRollover(self):
+        super(SizeRotatingFileHandler, self).doRollover()
+        self.bytes_written = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + getattr(self, 'terminator', '\n')
+            if self.stream is None:
+                self.stream = self._open()
+            if self.bytes_written is None and os.path.isfile(self.baseFilename):
+                self.bytes_written = os.path.getsize(self.baseFilename)
+            size = len(msg) if isinstance(msg, bytes) else len(msg.encode(getattr(self.stream, 'encoding', None) or 'utf-8', 'replace'))  # encoding may be 'locale'
+            if self.maxBytes > 0 and self.bytes_written and self.bytes_written + size >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(msg)
+            self.flush()
+            if self.bytes_written is not None:
+                self.bytes_written += size
+        except Exception:
+            self.handleError(record)
+
+
+class CompressingRotatingFileHandler(SizeRotatingFileHandler):
+    """
+    A size based rotating file handler that gzips rotated files on a background thread and limits the total disk usage of the logs.
+    Rotated files are named <filename>.<timestamp>.gz so they sort oldest first. After each compression the oldest rotated files
+    are deleted until the rotated files plus maxBytes for the live file fit in max_total_bytes.
+    Closing the handler waits for outstanding compressions to finish.
+    """
+    def __init__(self, filename, mode='a', maxBytes=52428800, max_total_bytes=524288000, encoding=None, delay=False):
+        """
+        Constructor for the handler.
+        Args:
+            filename: The path of the log file
+            mode: The mode to open the log file with (Optional, default: a)
+            maxBytes: The size at which the log file is rotated (Optional, default: 50MB)
+            max_total_bytes: The disk budget for the log file and its rotated files (Optional, default: 500MB)
+            encoding: The encoding of the log file (Optional)
+            delay: Set True to defer opening the log file until the first record is written (Default: False)
+        """
+        super(CompressingRotatingFileHandler, self).__init__(filename, mode=mode, maxBytes=maxBytes, encoding=encoding, delay=delay)
+        self.max_total_bytes = max_total_bytes
+        self._compress_queue = queue.Queue()
+        self._compress_thread = threading.Thread(target=self._compress_rotated_files, name='log-compressor')
+        self._compress_thread.daemon = True
+        self._compress_thread.start()
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            rotated_file = '{base}.{timestamp}'.format(base=self.baseFilename, timestamp=datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+            os.rename(self.baseFilename, rotated_file)
+            self._compress_queue.put(rotated_file)
+        if not self.delay:
+            self.stream = self._open()
+        self.bytes_written = 0
+
+    def close(self):
+        if self._compress_thread:
+            self._compress_queue.put(None)
+            self._compress_thread.join()
+            self._compress_thread = None
+        super(CompressingRotatingFileHandler, self).close()
+
+    def _compress_rotated_files(self):
+        """
+        Body of the background thread. Compresses rotated files as they are queued by doRollover until None is received.
+        """
+        for rotated_file in iter(self._compress_queue.get, None):
+            try:
+                with open(rotated_file, 'rb') as f_in, gzip.open(rotated_file + '.gz.tmp', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.rename(rotated_file + '.gz.tmp', rotated_file + '.gz')
+                os.remove(rotated_file)
+                self._remove_oldest_rotated_files()
+            except Exception as e:
+                sys.stderr.write('Failed to compress rotated log file {file}: {error}\n'.format(file=rotated_file, error=e))
+
+    def _remove_oldest_rotated_files(self):
+        """
+        Deletes the oldest compressed files until the rotated files and a full live log file fit within max_total_bytes.
+        Files still waiting to be compressed count towards the budget but are never deleted.
+        """
+        log_dir, log_name = os.path.split(self.baseFilename)
+        rotated_files = sorted(os.path.join(log_dir, name) for name in os.listdir(log_dir) if name.startswith(log_name + '.') and not name.endswith('.tmp'))
+        total_bytes = self.maxBytes + sum(os.path.getsize(rotated_file) for rotated_file in rotated_files)
+        for rotated_file in rotated_files:
+            if total_bytes <= self.max_total_bytes:
+                break
+            if not rotated_file.endswith('.gz'):
+                continue
+            total_bytes -= os.path.getsize(rotated_file)
+            os.remove(rotated_file)
+
+
+def _queue_logger_handlers(custom_logger, handlers):
+    """
+    Move handlers of a logger behind a queue. The logger is given a QueueHandler and the handlers are served by a QueueListener thread.
+    The listener is stopped at interpreter exit, which flushes any records still in the queue.
+    Args:
+        custom_logger: The logger the handlers are attached to
+        handlers: The handlers to move behind the queue
+    """
+    if not hasattr(logging.handlers, 'QueueHandler'):
+        raise Exception('Asynchronous logging requires Python 3')
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = listener
+    for handler in handlers:
+        custom_logger.removeHandler(handler)
+    custom_logger.addHandler(queue_handler)
+    listener.start()
+    global _queue_listeners
+    with _queue_listeners_lock:
+        if _queue_listeners is None:
+            _queue_listeners = set()
+            atexit.register(_stop_queue_listeners)
+        _queue_listeners.add(listener)
+
+
+def _stop_queue_listeners():
+    """
+    Stops the QueueListeners started for async_logging at interpreter exit.
+    """
+    with _queue_listeners_lock:
+        listeners = list(_queue_listeners)
+    for listener in listeners:
+        _stop_queue_listener(listener)
+
+
+def _stop_queue_listener(listener):
+    """
+    Stops a QueueListener, writing out any queued records. Safe to call on a listener that has already been stopped.
+    Args:
+        listener: The listener to stop
+    """
+    if getattr(listener, '_thread', None):
+        listener.stop()
+    with _queue_listeners_lock:
+        _queue_listeners.discard(listener)
+
+
+def get_logger_queue_depth(custom_logger):
+    """
+    Returns the number of records waiting to be written for a logger configured with async_logging.
+    A steadily growing value indicates the background writer is not keeping up.
+    Args:
+        custom_logger: The logger to inspect
+    Returns: The number of queued records. 0 if the logger is not using a queue
+    """
+    return sum(handler.queue.qsize() for handler in custom_logger.handlers if getattr(handler, 'listener', None))
+
+
+_LOG_RECORD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | frozenset(['message', 'asctime'])
+
+
+def _json_dumps(value):
+    """
+    Serialise a log record dict to a JSON string, using orjson when it is installed.
+    Args:
+        value: The dict to serialise
+    Returns: The JSON string
+    """
+    if orjson:
+        try:
+            return orjson.dumps(value, default=str).decode('utf-8')
+        except TypeError:
+            pass  # eg. integers beyond 64 bits. Let the json module deal with them
+    return json.dumps(value, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    A JSON log formatter producing the same fields as logmatic.JsonFormatter at a lower cost per record.
+    The hostname and AWX job details (tower_job_id, tower_job_template_name) are looked up once and added to every record,
+    the timestamp string is only rebuilt when the second changes and orjson is used for encoding if it is installed.
+    """
+    def __init__(self, datefmt='%Y-%m-%dT%H:%M:%SZ%z', extra=None):
+        """
+        Constructor for the formatter.
+        Args:
+            datefmt: The format of the asctime and timestamp fields. Must not include sub-second fields (Optional, default: the logmatic format)
+            extra: A dict of additional static fields to add to every record (Optional)
+        """
+        super(JsonFormatter, self).__init__(datefmt=datefmt)
+        self.static_fields = {'hostname': socket.gethostname()}
+        for env_var in ('tower_job_id', 'tower_job_template_name'):
+            if env_var in os.environ:
+                self.static_fields[env_var] = os.environ[env_var]
+        self.static_fields.update(extra or {})
+        self._time_cache = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached_second, cached_time = self._time_cache
+        if second != cached_second:
+            cached_time = time.strftime(datefmt or self.datefmt, self.converter(second))
+            self._time_cache = (second, cached_time)
+        return cached_time
+
+    def format(self, record):
+        log_record = {}
+        if isinstance(record.msg, dict):
+            log_record.update(record.msg)
+            record.message = None
+        else:
+            record.message = record.getMessage()
+        asctime = self.formatTime(record)
+        log_record.update({'asctime': asctime, 'name': record.name, 'processName': record.processName, 'filename': record.filename, 'funcName': record.funcName,
+                           'levelname': record.levelname, 'lineno': record.lineno, 'module': record.module, 'threadName': record.threadName, 'message': record.message,
+                           'pid': record.process})
+        log_record.update(self.static_fields)
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                log_record[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            log_record['exc_info'] = record.exc_text
+        log_record['timestamp'] = asctime
+        return _json_dumps(log_record)
+
+
 def replace_logger_formatter(custom_logger, formatter):
     """
     Replaces the formatter used by a logger's handlers.
+    Handlers moved behind a queue by configure_logger's async_logging are updated in place of the queue handler.
     Args:
         formatter: The formatter for formatting the log
     """
     for handler in custom_logger.handlers:
-        handler.setFormatter(formatter)
+        listener = getattr(handler, 'listener', None)
+        if listener:
+            for queued_handler in listener.handlers:
+                queued_handler.setFormatter(formatter)
+        else:
+            handler.setFormatter(formatter)
+
+
+class Redactor(object):
+    """
+    Masks secrets in text, including text arriving in chunks with a secret split between chunks.
+    All secrets are found in one pass with an Aho-Corasick automaton, so the cost is linear in the length of the text however many secrets there are.
+    Overlapping and adjacent occurrences are masked together. Used by exe_cmd(redact=...) and RedactingFilter.
+    Example:
+        redactor = Redactor([api_key, db_password])
+        exe_cmd('deploy.sh', redact=redactor)
+    """
+    def __init__(self, secrets=(), replacement='***'):
+        """
+        Args:
+            secrets: The secrets to mask (Optional)
+            replacement: The text to replace each secret with (Default: ***)
+        """
+        self.replacement = replacement
+        self._secrets = set()
+        self._automaton = None
+        for secret in secrets:
+            self.add(secret)
+
+    def add(self, secret):
+        """
+        Adds a secret to mask. Streams already started are not affected. Empty secrets are ignored.
+        """
+        if secret and secret not in self._secrets:
+            self._secrets.add(secret)
+            self._automaton = None
+
+    def redact(self, text):
+        """
+        Returns: The text with every secret masked
+        """
+        stream = self.stream()
+        return stream.feed(text) + stream.flush()
+
+    def stream(self):
+        """
+        Returns: A RedactorStream for masking secrets in text fed to it in chunks
+        """
+        if self._automaton is None:
+            self._automaton = _build_automaton(self._secrets)
+        return RedactorStream(self._automaton, self.replacement)
+
+
+class RedactorStream(object):
+    """
+    Masks secrets in text fed in chunks, returned by Redactor.stream.
+    The end of each chunk that could be the start of a secret is held back until the following chunk shows whether it is.
+    """
+    def __init__(self, automaton, replacement):
+        self._automaton = automaton
+        self._replacement = replacement
+        self._state = 0
+        self._buffer = ''
+        self._matches = []  # merged [start, end) ranges of secrets in the buffer
+
+    def feed(self, text):
+        """
+        Returns: The text fed so far that can no longer be part of a secret, masked
+        """
+        (goto, fail, match, depth, first_chars) = self._automaton
+        buffer = self._buffer + text
+        index = len(self._buffer)
+        state = self._state
+        while index < len(buffer):
+            if not state:
+                next_first = first_chars.search(buffer, index) if first_chars else None
+                if not next_first:
+                    break
+                index = next_first.start()
+            char = buffer[index]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            index += 1
+            if match[state]:
+                self._add_match(index - match[state], index)
+        self._state = state
+        return self._emit(buffer, len(buffer) - depth[state])
+
+    def flush(self):
+        """
+        Returns: The text held back, masked. The stream can then be reused
+        """
+        text = self._emit(self._buffer, len(self._buffer), final=True)
+        self._state = 0
+        return text
+
+    def _add_match(self, start, end):
+        """
+        Records a secret found in the buffer, merging it with the ranges it overlaps or adjoins. A longer secret can cover earlier, shorter ones
+        """
+        while self._matches and start <= self._matches[-1][1]:
+            (previous_start, previous_end) = self._matches.pop()
+            (start, end) = (min(start, previous_start), max(end, previous_end))
+        self._matches.append([start, end])
+
+    def _emit(self, buffer, safe, final=False):
+        """
+        Returns: The masked buffer up to where a secret could still start, keeping the rest in the buffer.
+            A masked secret ending there is kept too, as a secret right after it is masked with it
+        """
+        cut = safe if final else min([safe] + [start for (start, end) in self._matches if end >= safe])
+        parts = []
+        position = 0
+        for (start, end) in self._matches:
+            if end > cut:
+                break
+            parts.extend((buffer[position:start], self._replacement))
+            position = end
+        parts.append(buffer[position:cut])
+        self._buffer = buffer[cut:]
+        self._matches = [[start - cut, end - cut] for (start, end) in self._matches if end > cut]
+        return ''.join(parts)
+
+
+_Automaton = collections.namedtuple('_Automaton', ['goto', 'fail', 'match', 'depth', 'first_chars'])
+
+
+def _build_automaton(secrets):
+    """
+    Builds the Aho-Corasick automaton for a Redactor.
+    Returns: An _Automaton of per state lists of the transitions, the failure link, the length of the longest secret ending in the state
+        and the length of the state's prefix, with a regular expression matching the first characters of the secrets
+    """
+    goto = [{}]
+    fail = [0]
+    match = [0]
+    depth = [0]
+    for secret in secrets:
+        state = 0
+        for char in secret:
+            if char not in goto[state]:
+                goto[state][char] = len(goto)
+                goto.append({})
+                fail.append(0)
+                match.append(0)
+                depth.append(depth[state] + 1)
+            state = goto[state][char]
+        match[state] = len(secret)
+    queue = collections.deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for (char, next_state) in goto[state].items():
+            queue.append(next_state)
+            failure = fail[state]
+            while failure and char not in goto[failure]:
+                failure = fail[failure]
+            fail[next_state] = goto[failure].get(char, 0) if state else 0
+            match[next_state] = max(match[next_state], match[fail[next_state]])
+    first_chars = re.compile('|'.join(re.escape(char) for char in goto[0])) if goto[0] else None
+    return _Automaton(goto, fail, match, depth, first_chars)
+
+
+class RedactingFilter(logging.Filter):
+    """
+    A logging filter masking secrets in every record, using a Redactor. The message is formatted with its arguments before being masked,
+    and the exception traceback and stack information are formatted and masked too, replacing exc_info with the masked exc_text.
+    Add it to handlers rather than loggers, as filters on a logger do not apply to records from its child loggers.
+    Example:
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(RedactingFilter(redactor))
+    """
+    def __init__(self, redactor):
+        super(RedactingFilter, self).__init__()
+        self.redactor = redactor
+
+    def filter(self, record):
+        record.msg = self.redactor.redact(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None  # so formatters use the masked exc_text
+        if record.exc_text:
+            record.exc_text = self.redactor.redact(record.exc_text)
+        if getattr(record, 'stack_info', None):
+            record.stack_info = self.redactor.redact(record.stack_info)
+        return True
 
 
 def discover_github_latest_patch_release(version_to_match, release_url, pat=None):
@@ -103,56 +722,2130 @@ def discover_github_latest_patch_release(version_to_match, release_url, pat=None
     return version
 
 
-def exe_cmd(cmd, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False):
+def exe_cmd(cmd, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False, output_log_limit=None,
+            capture=None, read_size=None, log_tag=None, split_stderr=False, timeout=None, idle_timeout=None, return_result=False, cache=None, redact=None,
+            rlimits=None, nice=None, ionice=None, cpu_affinity=None):
     """
     Helper function for easily executing a command.
-        cmd: The command to execute
+        cmd: The command to execute. A string is run by the shell. A list of arguments is executed directly without a shell, which is quicker to start
+            and does not need shell_escape. OSError is raised if the executable does not exist
         working_dir: The directory to execution the command from (Optional)
         obfuscate: A value to obfuscate in the logging (Optional)
-        stdin: A string to pass as standard input to the process (Optional)
+        stdin: The standard input for the process (Optional). One of:
+            A string, which is written encoded as UTF-8, or bytes
+            A file object. A real file is passed directly to the process, otherwise it is read in blocks
+            An iterable of string or bytes chunks, such as a generator
+            Input is written from a separate thread while the output is read, so it need not fit in memory or in the pipe
         env: Custom environment variables to be used in place of parent envrionment variables (Optional, default: parent process environment variables)
         log_level: The default logging level. Default: INFO. Setting to None will disable logging in this function
         raise_exception: Whether to raise an exception if the command return a non-zero return code (Default: True)
         stream_log: When False, output will be logged when the process ends.
             When True, the process output will be logged as it arrives (causing more metadata to be printed) (Default: True)
+        output_log_limit: The maximum number of characters of output to include when logging the output at the end of the command or in the exception message.
+            Longer output is cut down to its beginning and end with a truncation marker in between. The returned output is not affected (Optional, default: no limit)
+        capture: An OutputCapture to collect the output with, to bound the memory used for large output or keep only the last lines.
+            See OutputCapture for what is returned as the output (Optional, default: all output is kept in memory)
+        read_size: Read the output in blocks of up to this many bytes rather than line by line, eg. DEFAULT_READ_SIZE.
+            This is much faster for large output. Output is decoded as UTF-8, replacing invalid bytes (Optional, default: output is read line by line)
+        log_tag: A tag to prefix all log lines for this command with, eg. the cluster name when running commands in parallel (Optional)
+        split_stderr: When True, the error output is captured separately from the output rather than merged into it, and returned as a third value.
+            Both pipes are read as output arrives so neither can fill up and block the command. Error output is included in the exception message.
+            Output is read in blocks, of read_size if set or DEFAULT_READ_SIZE otherwise. This does not work on Windows (Default: False)
+        timeout: The maximum number of seconds the command may run for (Optional, default: no limit)
+        idle_timeout: The maximum number of seconds the command may go without producing output (Optional, default: no limit)
+            When either timeout is exceeded, the command and any processes it started are sent SIGTERM and, if still running after KILL_GRACE_PERIOD
+            seconds, SIGKILL. The command is then handled as failed, with the output so far included in the exception message.
+            The command is started in its own process group for this. Output is read in blocks as for split_stderr. This requires Python 3 and does not work on Windows
+        return_result: When True, a CommandResult holding the run time and resource usage of the command is returned instead of a tuple (Default: False)
+        cache: A CommandCache to reuse the output of an earlier successful run of the same command from, for read-only commands.
+            A command is not executed when the cache has its output. Commands with a stream or file as stdin, or with a capture, are not cached (Optional)
+        redact: A Redactor whose secrets are masked in the logged command, the output and the error output as they are read.
+            The output is masked before it is logged, returned, captured or included in the exception message (Optional)
+        rlimits: Resource limits for the command, as a dict of the resource to the limit, or to a tuple of the soft and hard limits.
+            Resources are resource module constants or their names without RLIMIT_, eg. {'AS': 4 * 1024 ** 3, 'CPU': 600, 'NOFILE': 1024} (Optional)
+        nice: An increment to the niceness of the command, eg. 10 (Optional)
+        ionice: The I/O scheduling class of the command: 'idle', 'best-effort' or 'realtime', or a tuple of the class and a priority from 0 (highest) to 7 (Optional)
+        cpu_affinity: The CPUs the command may run on, eg. {0, 1} (Optional)
+            rlimits, nice, ionice and cpu_affinity are applied in the child before exec. subprocess cannot use vfork then, so starting the command is slower
+            in a large process. See start_spawn_server. They do not work on Windows
+    Returns: A tuple of the return code and the output. With split_stderr, a tuple of the return code, the output and the error output
+    Example:
+        result = exe_cmd('helm upgrade --install ...', return_result=True)
+        logger.info('{cpu} seconds of CPU time, {rss} bytes max RSS'.format(cpu=result.user_time + result.system_time, rss=result.max_rss))
     """
+    cache_key = cache.key(cmd, working_dir=working_dir, env=env, stdin=stdin, split_stderr=split_stderr) if cache and not capture else None
+    result = cache.get(cache_key) if cache_key else None
+    if result:
+        logger.info('{prefix}Using cached output of: {cmd}'.format(prefix='[{tag}] '.format(tag=log_tag) if log_tag is not None else '', cmd=_obfuscate_cmd(cmd, obfuscate)))
+        return result if return_result else tuple(result)
+    stream = CommandStream(cmd, working_dir=working_dir, obfuscate=obfuscate, stdin=stdin, env=env, log_level=log_level, raise_exception=raise_exception,
+                           stream_log=stream_log, read_size=read_size, capture=capture or OutputCapture(), log_output=not stream_log, output_log_limit=output_log_limit,
+                           log_tag=log_tag, split_stderr=split_stderr, timeout=timeout, idle_timeout=idle_timeout, redact=redact, rlimits=rlimits, nice=nice,
+                           ionice=ionice, cpu_affinity=cpu_affinity)
+    for _ in stream:
+        pass
+    if cache_key and not stream.rc and not stream.timed_out:
+        cache.set(cache_key, stream.result)
+    return stream.result if return_result else tuple(stream.result)
 
-    obfus_cmd = cmd.replace(obfuscate, '***') if obfuscate else cmd
-    logger.info('Executing: %s' % (obfus_cmd))
 
-    if os.name == 'nt' and sys.version_info[0] == 3:
-        # the encoding is needed for windows & python3
-        p = subprocess.Popen(cmd, shell=True, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8',
-                             stdin=subprocess.PIPE if stdin else None, cwd=working_dir, universal_newlines=True, env=env)
-    else:
-        p = subprocess.Popen(cmd, shell=True, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             stdin=subprocess.PIPE if stdin else None, cwd=working_dir, universal_newlines=True, env=env)
-
-    if stdin:
-        p.stdin.write(stdin)
-        p.stdin.close()
-    output = ''
-    for line in iter(p.stdout.readline, ''):
-        output += line
-        if line.strip():
-            if stream_log:
-                logger.log(log_level, line.rstrip())
-
-    if not stream_log:
-        logger.info('Command output: %s' % (output))
-    p.stdout.close()
-    rc = p.wait()
-    if rc:
-        if raise_exception:
-            raise Exception('Error executing command: {cmd}. RC: {rc}. Output: {output}'.format(
-                cmd=obfus_cmd,
-                rc=rc,
-                output='***' if log_level == logging.NOTSET else output))
+def exe_pipeline(cmds, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False, output_log_limit=None,
+                 capture=None, read_size=None, log_tag=None, timeout=None, idle_timeout=None, redact=None, rlimits=None, nice=None, ionice=None, cpu_affinity=None):
+    """
+    Helper function for executing a pipeline of commands, each reading the output of the one before, as with cmd1 | cmd2 | cmd3 in a shell.
+    The stages are connected with pipes directly, so the data passed between them is not read or copied by Python.
+    Only the output of the last stage is captured, along with the error output of every stage. Logging and errors are as for exe_cmd.
+    The pipeline fails if any stage fails, and its return code is that of the last failing stage, as with bash's pipefail.
+    Pipelines are started directly, not through the spawn server.
+    Args:
+        cmds: The commands of the pipeline. Each is a string run by the shell or a list of arguments. See exe_cmd
+        stdin: The standard input for the first stage. See exe_cmd (Optional)
+        rlimits, nice, ionice, cpu_affinity: Applied to every stage. See exe_cmd (Optional)
+        See exe_cmd for the other arguments
+    Returns: A tuple of the return code, the output and a list of the return codes of the stages
+    Example:
+        (rc, output, stage_rcs) = exe_pipeline(['kubectl get pods -o json', ['jq', '.items[].metadata.name'], 'sort'])
+    """
+    stream = CommandStream(cmds, working_dir=working_dir, obfuscate=obfuscate, stdin=stdin, env=env, log_level=log_level, raise_exception=raise_exception,
+                           stream_log=stream_log, read_size=read_size, capture=capture or OutputCapture(), log_output=not stream_log, output_log_limit=output_log_limit,
+                           log_tag=log_tag, timeout=timeout, idle_timeout=idle_timeout, redact=redact, rlimits=rlimits, nice=nice, ionice=ionice,
+                           cpu_affinity=cpu_affinity, pipeline=True)
+    for _ in stream:
+        pass
+    return (stream.rc, stream.output, stream.stage_rcs)
+
+
+def exe_cmds(cmds, max_workers=10, fail_fast=True, **kwargs):
+    """
+    Helper function for executing many independent commands in parallel with exe_cmd on a pool of threads.
+    Every log line of a command, including streamed output with stream_log, is prefixed with the command's tag.
+    Args:
+        cmds: A list of commands, or a dict of tag to command. The tag of a command in a list is its index
+        max_workers: The maximum number of commands to run at once (Default: 10)
+        fail_fast: When True, the first command to raise an exception stops any commands that have not started yet and its exception is raised
+            once the running commands finish. When False, all commands are run and a single exception listing every failure is raised at the end.
+            Exception messages are prefixed with the command's tag (Default: True)
+        **kwargs: Any other arguments are passed to exe_cmd for every command, eg. raise_exception=False to get the results of failing commands instead
+    Returns: A list of the (rc, output) tuples of the commands, in the order of cmds
+    Example:
+        results = exe_cmds({cluster: 'kubectl --context {c} get nodes'.format(c=cluster) for cluster in clusters}, max_workers=20, stream_log=True)
+    """
+    tagged_cmds = list(cmds.items()) if isinstance(cmds, dict) else list(enumerate(cmds))
+    failures = []
+
+    def run_cmd(tag, cmd):
+        if fail_fast and failures:
+            return None  # skipped as an earlier command failed
+        try:
+            return exe_cmd(cmd, log_tag=tag, **kwargs)
+        except Exception as e:
+            failures.append(e)
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_cmd, tag, cmd) for (tag, cmd) in tagged_cmds]
+    if failures and fail_fast:
+        raise failures[0]
+    if failures:
+        errors = [str(future.exception()) for future in futures if future.exception()]
+        raise Exception('{count} of {total} commands failed:\n{errors}'.format(count=len(errors), total=len(futures), errors='\n'.join(errors)))
+    return [future.result() for future in futures]
+
+
+def iter_cmd(cmd, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False, read_size=None, log_tag=None,
+             timeout=None, idle_timeout=None, redact=None, rlimits=None, nice=None, ionice=None, cpu_affinity=None):
+    """
+    Helper function for executing a command and processing its output as it arrives, rather than once the command ends as with exe_cmd.
+    The output is not kept, so memory use does not grow with the size of the output.
+    Args:
+        cmd: The command to execute. A string is run by the shell, a list of arguments is executed directly. See exe_cmd
+        working_dir: The directory to execute the command from (Optional)
+        obfuscate: A value to obfuscate in the logging (Optional)
+        stdin: The standard input for the process (Optional). One of:
+            A string, which is written encoded as UTF-8, or bytes
+            A file object. A real file is passed directly to the process, otherwise it is read in blocks
+            An iterable of string or bytes chunks, such as a generator
+            Input is written from a separate thread while the output is read, so it need not fit in memory or in the pipe
+        env: Custom environment variables to be used in place of parent environment variables (Optional, default: parent process environment variables)
+        log_level: The default logging level. Default: INFO. Setting to None will disable logging in this function
+        raise_exception: Whether to raise an exception at the end of iteration if the command returns a non-zero return code.
+            The exception message includes the last lines of output (Default: True)
+        stream_log: When True, the process output will be logged as it arrives (Default: False)
+        read_size: Yield blocks of output of up to this many bytes, eg. DEFAULT_READ_SIZE, rather than lines (Optional, default: lines are yielded)
+        log_tag: A tag to prefix all log lines for this command with (Optional)
+        timeout: The maximum number of seconds the command may run for. See exe_cmd (Optional, default: no limit)
+        idle_timeout: The maximum number of seconds the command may go without producing output. See exe_cmd (Optional, default: no limit)
+        redact: A Redactor whose secrets are masked in the output. See exe_cmd (Optional)
+        rlimits, nice, ionice, cpu_affinity: Resource limits and scheduling for the command. See exe_cmd (Optional)
+    Returns: A CommandStream. The command is started when iteration begins. Once iteration completes, its rc attribute holds the return code
+    Example:
+        stream = iter_cmd('kubectl get pods --no-headers')
+        for line in stream:
+            process(line)
+        logger.info(stream.rc)
+    """
+    return CommandStream(cmd, working_dir=working_dir, obfuscate=obfuscate, stdin=stdin, env=env, log_level=log_level, raise_exception=raise_exception,
+                         stream_log=stream_log, read_size=read_size, capture=OutputCapture(tail_lines=ITER_CMD_ERROR_LINES), log_tag=log_tag, timeout=timeout,
+                         idle_timeout=idle_timeout, redact=redact, rlimits=rlimits, nice=nice, ionice=ionice, cpu_affinity=cpu_affinity)
+
+
+def iter_cmd_json(cmd, path='items', json_lines=False, **kwargs):
+    """
+    Helper function for executing a command that outputs JSON and processing the items of an array in it as they arrive, eg. the items of a Kubernetes list.
+    The JSON is parsed incrementally from the output, so memory use is proportional to the largest item rather than to the whole output.
+    Args:
+        cmd: The command to execute. See exe_cmd
+        path: The dot separated keys of the array in the top-level JSON object to yield the items of, or None when the output is itself an array (Default: items)
+            The rest of the output is not parsed once the array ends
+        json_lines: Set True to yield every JSON value of output made of one value after another, such as JSON Lines or the output of jq. path is ignored (Default: False)
+        read_size: The maximum number of bytes of output to read at a time (Default: DEFAULT_READ_SIZE)
+        **kwargs: Any other arguments are passed to iter_cmd. The command's exception for a non-zero return code takes precedence over a parsing error
+    Returns: A generator of the parsed items. A ValueError is raised if the output is not valid JSON or has no array at the path.
+        The command is waited for and its return code checked once the items end. If iteration is abandoned, the command is terminated
+    Example:
+        for pod in iter_cmd_json('kubectl get pods --all-namespaces -o json'):
+            process(pod['metadata']['name'])
+    """
+    stream = iter_cmd(cmd, read_size=kwargs.pop('read_size', None) or DEFAULT_READ_SIZE, **kwargs)
+    stream.capture = _TailCapture(ITER_CMD_ERROR_SIZE)  # the output may be a single line
+    chunks = iter(stream)
+    parser = _JsonStreamParser(chunks)
+    try:
+        try:
+            for item in parser.values() if json_lines else parser.array_items(path.split('.') if path else []):
+                yield item
+        except ValueError:
+            for _ in chunks:
+                pass  # a failing command raises its own exception
+            raise
+        for _ in chunks:
+            pass  # the rest of the output is not parsed, but the command is finished
+    finally:
+        chunks.close()
+
+
+class CommandResult(object):
+    """
+    The result of a command run with exe_cmd(return_result=True). Unpacks like the tuple exe_cmd returns otherwise.
+    Times are in seconds and max_rss is in bytes. The CPU times and max_rss cover the command and the processes it started,
+    and are None where the resource usage is not available, such as on Windows.
+    """
+    __slots__ = ('rc', 'output', 'stderr', 'wall_time', 'user_time', 'system_time', 'max_rss')
+
+    def __init__(self, rc, output, stderr=None, wall_time=None, rusage=None):
+        self.rc = rc
+        self.output = output
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.user_time = rusage.ru_utime if rusage else None
+        self.system_time = rusage.ru_stime if rusage else None
+        self.max_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024) if rusage else None  # linux reports kilobytes and macOS bytes
+
+    def __iter__(self):
+        return iter((self.rc, self.output) if self.stderr is None else (self.rc, self.output, self.stderr))
+
+    def __repr__(self):
+        return 'CommandResult(rc={rc}, wall_time={wall_time}, user_time={user_time}, system_time={system_time}, max_rss={max_rss})'.format(
+            rc=self.rc, wall_time=self.wall_time, user_time=self.user_time, system_time=self.system_time, max_rss=self.max_rss)
+
+
+class CommandCache(object):
+    """
+    A cache of the output of successful commands for exe_cmd(cache=...), for read-only commands run repeatedly, such as kubectl version.
+    Commands are matched on the command, working directory, environment and stdin. Only commands returning 0 within their timeouts are cached.
+    The environment matched is the env argument, or the process's environment when it is not given, so that eg. a change of KUBECONFIG is a different command.
+    Entries expire after the ttl and the least recently used entries are dropped beyond max_size.
+    With a path, entries are also stored as files in that directory so that separate processes share them. The output is stored unencrypted.
+    Example:
+        cache = CommandCache(ttl=600, path='/tmp/job-cache')
+        (rc, output) = exe_cmd('ibmcloud ks cluster get --cluster {c}'.format(c=cluster), cache=cache)
+    """
+    def __init__(self, ttl=300, max_size=256, path=None):
+        """
+        Args:
+            ttl: The number of seconds entries are used for (Default: 300)
+            max_size: The maximum number of entries to keep in memory, and on disk with a path (Default: 256)
+            path: A directory to also store the entries in. It is created if needed (Optional, default: entries are only kept in memory)
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise  # the directory was not created concurrently by another process
+
+    def key(self, cmd, working_dir=None, env=None, stdin=None, split_stderr=False):
+        """
+        Returns: The cache key for a command, or None if the command cannot be cached because its stdin is a stream or file
+        """
+        if stdin is not None and not isinstance(stdin, (bytes, type(u''))):
+            return None
+        stdin = stdin.encode('utf-8') if isinstance(stdin, type(u'')) else stdin
+        key = json.dumps([cmd, os.path.abspath(working_dir or os.curdir), sorted((env if env is not None else os.environ).items()),
+                          hashlib.sha256(stdin).hexdigest() if stdin is not None else None, split_stderr])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Returns: A copy of the CommandResult cached for the key, or None if there is no entry or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] + self.ttl > time.time():
+                self._entries[key] = self._entries.pop(key)  # mark as most recently used
+            else:
+                self._entries.pop(key, None)
+                entry = None
+        if not entry and self.path:
+            entry = self._read_file(key)
+            if entry:
+                self._store(key, entry)
+        return CommandResult(entry[1].rc, entry[1].output, stderr=entry[1].stderr) if entry else None
+
+    def set(self, key, result):
+        """
+        Caches the result of a command.
+        Args:
+            key: The key from CommandCache.key
+            result: The CommandResult of the command
+        """
+        entry = (time.time(), CommandResult(result.rc, result.output, stderr=result.stderr))
+        self._store(key, entry)
+        if self.path:
+            self._write_file(key, entry)
+
+    def clear(self):
+        """
+        Removes all entries, including those stored on disk.
+        """
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            for name in os.listdir(self.path):
+                if name.endswith('.json'):
+                    _remove_file(os.path.join(self.path, name))
+
+    def _store(self, key, entry):
+        """
+        Stores an entry in memory, dropping the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _read_file(self, key):
+        """
+        Returns: The unexpired (time, CommandResult) entry stored on disk for the key, or None
+        """
+        file_path = os.path.join(self.path, key + '.json')
+        try:
+            with open(file_path) as f:
+                data = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None  # there is no entry, or it is being replaced
+        if data['time'] + self.ttl <= time.time():
+            _remove_file(file_path)
+            return None
+        return (data['time'], CommandResult(data['rc'], data['output'], stderr=data['stderr']))
+
+    def _write_file(self, key, entry):
+        """
+        Stores an entry on disk, replacing the file atomically so that other processes never read a partial entry,
+        and removes the oldest entries beyond max_size.
+        """
+        (fd, temp_path) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': entry[0], 'rc': entry[1].rc, 'output': entry[1].output, 'stderr': entry[1].stderr}, f)
+        os.rename(temp_path, os.path.join(self.path, key + '.json'))
+        file_paths = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.json')]
+        if len(file_paths) > self.max_size:
+            for file_path in sorted(file_paths, key=_mtime)[:len(file_paths) - self.max_size]:
+                _remove_file(file_path)
+
+
+def _mtime(file_path):
+    """
+    Returns: The modification time of a file, or 0 if it no longer exists
+    """
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return 0
+
+
+def _remove_file(file_path):
+    """
+    Removes a file if it still exists.
+    """
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass  # already removed, eg. by another process sharing the cache
+
+
+@contextlib.contextmanager
+def record_commands(path):
+    """
+    Context manager recording the result of every command run with exe_cmd, iter_cmd, exe_pipeline or exe_cmds to a fixture file, for replay_commands.
+    Recording can also be switched on for a whole process by setting the BASEUTILS_RECORD_COMMANDS environment variable to the path.
+    The fixture is a JSON Lines file, gzipped if the path ends in .gz. Each line holds the logged command, a hash identifying the command,
+    its working directory, environment and stdin, and the return code, output, error output and duration, or the error starting the command.
+    The output is stored as returned, so use redact to keep secrets out.
+    Commands run by ShellSession and the asyncio helpers are not recorded.
+    Args:
+        path: The fixture file to write. It is replaced if it exists
+    Example:
+        with record_commands('fixtures/upgrade.jsonl.gz'):
+            upgrade_clusters()
+    """
+    with _use_command_fixture(_CommandFixture(path, replaying=False)):
+        yield
+
+
+@contextlib.contextmanager
+def replay_commands(path):
+    """
+    Context manager replaying the results recorded by record_commands in place of running the commands, for fast and repeatable runs without their dependencies.
+    Replay can also be switched on for a whole process by setting the BASEUTILS_REPLAY_COMMANDS environment variable to the path.
+    Commands are matched on the command, the working directory, the env argument and stdin. A command recorded several times replays its results in the order recorded.
+    The results are logged and raised as exceptions as when recorded. An exception is raised for a command with no result left to replay.
+    Args:
+        path: The fixture file to read
+    Example:
+        with replay_commands('fixtures/upgrade.jsonl.gz'):
+            upgrade_clusters()
+    """
+    with _use_command_fixture(_CommandFixture(path, replaying=True)):
+        yield
+
+
+@contextlib.contextmanager
+def _use_command_fixture(fixture):
+    """
+    Context manager making a fixture the one used by CommandStream, restoring the previous one afterwards.
+    """
+    global _command_fixture
+    previous = _command_fixture
+    _command_fixture = fixture
+    try:
+        yield
+    finally:
+        _command_fixture = previous
+        fixture.close()
+
+
+def _get_command_fixture():
+    """
+    Returns: The _CommandFixture commands are being recorded to or replayed from, or None.
+        A fixture from record_commands or replay_commands is used over one set by environment variable
+    """
+    if _command_fixture:
+        return _command_fixture
+    for (env_var, replaying) in ((_REPLAY_COMMANDS_ENV, True), (_RECORD_COMMANDS_ENV, False)):
+        path = os.environ.get(env_var)
+        if path:
+            with _command_fixtures_lock:
+                if (path, replaying) not in _env_command_fixtures:
+                    _env_command_fixtures[(path, replaying)] = fixture = _CommandFixture(path, replaying=replaying)
+                    atexit.register(fixture.close)
+                return _env_command_fixtures[(path, replaying)]
+    return None
+
+
+class _CommandFixture(object):
+    """
+    A fixture file of recorded command results. See record_commands and replay_commands.
+    """
+    def __init__(self, path, replaying):
+        self.path = path
+        self.replaying = replaying
+        self._lock = threading.Lock()
+        self._file = None
+        self._entries = collections.defaultdict(collections.deque)
+        if replaying:
+            with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+                for line in f:
+                    entry = json.loads(line.decode('utf-8'))
+                    self._entries[entry['key']].append(entry)
         else:
-            logger.info('Command returned RC {rc} but received instruction not to raise exception. This may be normal'.format(rc=rc))
-    else:
-        logger.info('Command successful. Returning output')
-    return (rc, output)
+            self._file = gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb')
+
+    def record(self, stream, output):
+        """
+        Writes the result of a finished CommandStream to the fixture.
+        Args:
+            stream: The CommandStream
+            output: The full output of the command, which the stream's output attribute may only hold the end of
+        """
+        entry = {'cmd': stream.obfus_cmd, 'key': _command_fixture_key(stream), 'rc': stream.rc, 'output': output, 'stderr': stream.stderr,
+                 'timed_out': stream.timed_out, 'stage_rcs': stream.stage_rcs, 'duration': round(stream.result.wall_time, 6)}
+        self._write(entry)
+
+    def record_error(self, stream, error):
+        """
+        Writes the OSError raised starting the command of a CommandStream to the fixture, such as for a missing executable.
+        """
+        self._write({'cmd': stream.obfus_cmd, 'key': _command_fixture_key(stream), 'error': [error.errno, error.strerror, error.filename]})
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._file:
+                self._file.write(line)
+                self._file.flush()
+
+    def replay(self, stream):
+        """
+        Returns: The next recorded entry for the command of a CommandStream. Raises an exception if there is none
+        """
+        with self._lock:
+            entries = self._entries.get(_command_fixture_key(stream))
+            if not entries:
+                raise Exception('{prefix}No recorded result to replay for command: {cmd}'.format(prefix=stream.log_prefix, cmd=stream.obfus_cmd))
+            return entries.popleft()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def _command_fixture_key(stream):
+    """
+    Returns: A hash identifying the command, working directory, env argument and stdin of a CommandStream, without exposing them in the fixture.
+        Stdin streams are not hashed
+    """
+    stdin = stream.stdin.encode('utf-8') if isinstance(stream.stdin, type(u'')) else stream.stdin
+    key = json.dumps([stream.cmd, stream.working_dir, sorted(stream.env.items()) if stream.env is not None else None,
+                      hashlib.sha256(stdin).hexdigest() if isinstance(stdin, bytes) else None])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class CommandStream(object):
+    """
+    An iterable over the output of a command, used by exe_cmd and returned by iter_cmd. See iter_cmd for details.
+    Every piece of output is also written to the capture, which provides the output attribute and the output in the exception message.
+    After iteration completes, rc holds the return code, output holds the captured output and result holds a CommandResult.
+    With split_stderr, only the output is yielded and the error output is captured in full to the stderr attribute.
+    If iteration is abandoned or interrupted by an exception, eg. from the timeout context manager, the command is terminated and waited for.
+    """
+    def __init__(self, cmd, working_dir=None, obfuscate=None, stdin=None, env=None, log_level=logging.INFO, raise_exception=True, stream_log=False,
+                 read_size=None, capture=None, log_output=False, output_log_limit=None, log_tag=None, split_stderr=False, timeout=None, idle_timeout=None,
+                 redact=None, rlimits=None, nice=None, ionice=None, cpu_affinity=None, pipeline=False):
+        """
+        Constructor for the stream. See exe_cmd for the arguments not described here.
+        Args:
+            capture: The OutputCapture that output is written to (Optional, default: the output is not kept)
+            log_output: Whether to log the captured output once the output ends (Default: False)
+            pipeline: Whether cmd is a list of commands to run as a pipeline. See exe_pipeline (Default: False)
+        """
+        self.cmd = cmd
+        self.pipeline = pipeline
+        self.obfus_cmd = ' | '.join(_obfuscate_cmd(stage, obfuscate) for stage in cmd) if pipeline else _obfuscate_cmd(cmd, obfuscate)
+        self.redact = redact
+        if redact:
+            self.obfus_cmd = redact.redact(self.obfus_cmd)
+        self.working_dir = working_dir
+        self.stdin = stdin
+        self.env = env
+        self.log_level = log_level
+        self.raise_exception = raise_exception
+        self.stream_log = stream_log
+        self.read_size = read_size
+        self.capture = capture
+        self.log_output = log_output
+        self.output_log_limit = output_log_limit
+        self.log_prefix = '[{tag}] '.format(tag=log_tag) if log_tag is not None else ''
+        self.split_stderr = split_stderr
+        self.limits = _child_limits(rlimits=rlimits, nice=nice, ionice=ionice, cpu_affinity=cpu_affinity)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._new_session = bool(timeout or idle_timeout)
+        self.rc = None
+        self.output = None
+        self.stderr = None
+        self.timed_out = None
+        self.stage_rcs = None
+        self.result = None
+        self._fixture = None
+        self._record_capture = None
+        self._stdin_error = None
+        self._deadline = None
+        self._start_time = None
+        self._rusage = None
+        self._log_lines = _LineBuffer() if stream_log else None
+        self._redactor_stream = None
+        self._stderr_capture = OutputCapture() if split_stderr else None
+        self._log_stderr_lines = _LineBuffer() if stream_log and split_stderr else None
+        self._binary = bool(read_size or split_stderr or timeout or idle_timeout)
+
+    def __iter__(self):
+        self._fixture = _get_command_fixture()
+        if self._fixture and self._fixture.replaying:
+            self._log_start(action='Replaying')
+            for data in self._replay():
+                yield data
+            self._finish()
+            return
+        self._log_start()
+        self._start_recording()
+        self._deadline = _monotonic() + self.timeout if self.timeout else None
+        p = self._start()
+        _register_children(p, self.obfus_cmd, new_session=self._new_session)
+        if p.stdin:
+            _start_stdin_writer(p.stdin, self.stdin, functools.partial(self._stdin_failed, p))
+        try:
+            for (pipe, data) in self._read(p):
+                if pipe is p.stderr:
+                    self._handle_stderr(data)
+                    continue
+                self._handle_output(data)
+                yield data
+        except _OutputTimeout:
+            self._time_out(p)
+        except BaseException:
+            self._rusage = _terminate_children(p, new_session=self._new_session)
+            if self._record_capture:
+                self._record_capture.close()
+            raise
+        finally:
+            p.stdout.close()
+            if p.stderr:
+                p.stderr.close()
+            self.rc = self._wait(p)
+            _unregister_children(p)
+        self._finish()
+
+    def _replay(self):
+        """
+        Generator passing the recorded output of the command to the stream in place of running it. See replay_commands.
+        Returns: A generator of the output, line by line unless read_size is set
+        """
+        entry = self._fixture.replay(self)
+        if entry.get('error'):
+            raise OSError(*entry['error'])
+        if (entry['stderr'] is not None) != bool(self.split_stderr):
+            raise Exception('{prefix}The result of command {cmd} was recorded with split_stderr={recorded} and cannot be replayed with split_stderr={split}'.format(
+                prefix=self.log_prefix, cmd=self.obfus_cmd, recorded=entry['stderr'] is not None, split=bool(self.split_stderr)))
+        for data in (entry['output'].splitlines(True) if not self.read_size else [entry['output']]):
+            self._handle_output(data)
+            yield data
+        if entry['stderr']:
+            self._handle_stderr(entry['stderr'])
+        (self.rc, self.timed_out, self.stage_rcs) = (entry['rc'], entry['timed_out'], entry['stage_rcs'])
+
+    def _start_recording(self):
+        """
+        Captures the output separately for a fixture being recorded when the stream's capture does not keep all of it, as for iter_cmd. See record_commands.
+        """
+        if self._fixture and not (isinstance(self.capture, OutputCapture) and self.capture._keeps_all()):
+            self._record_capture = OutputCapture(max_memory=DEFAULT_READ_SIZE)
+
+    def _start(self):
+        """
+        Starts the command, or the stages of the pipeline.
+        Returns: The subprocess.Popen-like object
+        """
+        try:
+            if self.pipeline:
+                return _popen_pipeline(self.cmd, working_dir=self.working_dir, stdin=self.stdin, env=self.env, text=not self._binary,
+                                       new_session=self._new_session, limits=self.limits)
+            return _popen_cmd(self.cmd, working_dir=self.working_dir, stdin=self.stdin, env=self.env, text=not self._binary, split_stderr=self.split_stderr,
+                              new_session=self._new_session, limits=self.limits)
+        except OSError as e:
+            if self._fixture:
+                self._fixture.record_error(self, e)
+            raise
+
+    def _stdin_failed(self, p, error):
+        """
+        Keeps an error writing the standard input to raise once the output ends, and terminates the command so that it does not run on incomplete input.
+        Called from the thread writing the standard input, before the pipe is closed.
+        """
+        self._stdin_error = error
+        if p.returncode is None:
+            for pid in _process_ids(p):
+                (pids, process_groups) = _command_processes(pid, self._new_session)
+                _signal_processes(pids, signal.SIGTERM, process_groups)
+
+    def _read(self, p):
+        """
+        Returns: A generator of (pipe, data) tuples for the output of a started command.
+            The output and error output are multiplexed with split_stderr, the output is read with timeouts if they are set and secrets are masked with redact
+        """
+        if self.split_stderr or self.timeout or self.idle_timeout:
+            assert_linux()
+            output = _multiplex_output([p.stdout, p.stderr] if self.split_stderr else [p.stdout], read_size=self.read_size or DEFAULT_READ_SIZE,
+                                       deadline=self._deadline, idle_timeout=self.idle_timeout)
+        elif self.redact:
+            output = ((p.stdout, data) for data in _read_output(p.stdout, read_size=self.read_size))
+        else:
+            return ((p.stdout, data) for data in _read_output(p.stdout, read_size=self.read_size))
+        if self.redact:
+            output = _redact_output(output, self.redact)
+        return output if self.read_size else _split_lines(output)
+
+    def _time_out(self, p):
+        """
+        Records which timeout was exceeded and kills the command's process group.
+        """
+        if self._deadline is not None and _monotonic() >= self._deadline:
+            self.timed_out = 'Timed out after {timeout} seconds'.format(timeout=self.timeout)
+        else:
+            self.timed_out = 'No output for {timeout} seconds'.format(timeout=self.idle_timeout)
+        logger.warning('{prefix}{reason}. Killing command: {cmd}'.format(prefix=self.log_prefix, reason=self.timed_out, cmd=self.obfus_cmd))
+        self._rusage = _kill_process_group(p)
+
+    def _wait(self, p):
+        """
+        Waits for the command to exit, applying the remaining timeout if there is one.
+        Returns: The return code
+        """
+        if p.returncode is None:
+            try:
+                self._rusage = _wait_process(p, timeout=None if self._deadline is None else max(0, self._deadline - _monotonic()))
+            except subprocess.TimeoutExpired:
+                self._time_out(p)
+        if p.returncode is None:
+            self._rusage = _wait_process(p)
+        if self.pipeline:
+            self.stage_rcs = p.returncodes
+        return p.returncode
+
+    def _log_start(self, action='Executing'):
+        """
+        Logs the command about to be executed, or replayed, and starts timing it.
+        """
+        logger.info('%s%s: %s' % (self.log_prefix, action, self.obfus_cmd))
+        self._start_time = _monotonic()
+
+    def _handle_output(self, data):
+        """
+        Captures and stream logs a piece of output as it is read.
+        """
+        if self.capture:
+            self.capture.write(data)
+        if self._record_capture:
+            self._record_capture.write(data)
+        if self._log_lines:
+            _log_lines(self._log_lines.feed(data), self.log_level, prefix=self.log_prefix)
+
+    def _feed_output(self, text, final=False):
+        """
+        Passes output read by a caller running the command itself, as ShellSession and exe_cmd_async do, to the stream, masking secrets with redact.
+        Args:
+            text: The output
+            final: Whether this is the end of the output, when any output held back for redact is passed on
+        """
+        if self.redact:
+            self._redactor_stream = self._redactor_stream or self.redact.stream()
+            text = self._redactor_stream.feed(text) + (self._redactor_stream.flush() if final else '')
+        if text:
+            self._handle_output(text)
+
+    def _handle_stderr(self, data):
+        """
+        Captures and stream logs a piece of error output with split_stderr.
+        """
+        self._stderr_capture.write(data)
+        if self._log_stderr_lines:
+            _log_lines(self._log_stderr_lines.feed(data), self.log_level, prefix=self.log_prefix)
+
+    def _finish(self):
+        """
+        Logs the remaining output and handles the return code once the output has been read and rc has been set.
+        """
+        for line_buffer in (self._log_lines, self._log_stderr_lines):
+            if line_buffer:
+                _log_lines(line_buffer.flush(), self.log_level, prefix=self.log_prefix)
+        self.output = self.capture.getvalue() if self.capture else ''
+        self.stderr = self._stderr_capture.getvalue() if self._stderr_capture else None
+        if self.log_output and self.log_level is not None and logger.isEnabledFor(self.log_level):
+            logger.log(self.log_level, '%sCommand output: %s', self.log_prefix, _truncate_output(self.output, self.output_log_limit))
+            if self.stderr:
+                logger.log(self.log_level, '%sCommand error output: %s', self.log_prefix, _truncate_output(self.stderr, self.output_log_limit))
+        self.result = CommandResult(self.rc, self.output, stderr=self.stderr, wall_time=_monotonic() - self._start_time, rusage=self._rusage)
+        logger.debug('%sCommand resources: %r', self.log_prefix, self.result)
+        if self._stdin_error:
+            raise self._stdin_error
+        if self._fixture and not self._fixture.replaying:
+            self._fixture.record(self, self._record_capture.getvalue() if self._record_capture else self.output)
+        if self.rc or self.timed_out:
+            if self.raise_exception:
+                raise Exception(self._error_message())
+            else:
+                logger.info('{prefix}Command returned RC {rc} but received instruction not to raise exception. This may be normal'.format(prefix=self.log_prefix, rc=self.rc))
+        else:
+            logger.info('{prefix}Command successful. Returning output'.format(prefix=self.log_prefix))
+
+    def _error_message(self):
+        """
+        Returns: The message of the exception raised for a non-zero return code
+        """
+        message = '{prefix}Error executing command: {cmd}. {timed_out}RC: {rc}. {stage_rcs}Output: {output}'.format(
+            prefix=self.log_prefix,
+            cmd=self.obfus_cmd,
+            timed_out=self.timed_out + '. ' if self.timed_out else '',
+            rc=self.rc,
+            stage_rcs='Stage RCs: {rcs}. '.format(rcs=self.stage_rcs) if self.stage_rcs else '',
+            output='***' if self.log_level == logging.NOTSET else _truncate_output(self.output, self.output_log_limit))
+        if self.split_stderr:
+            message += '. Error output: {stderr}'.format(stderr='***' if self.log_level == logging.NOTSET else _truncate_output(self.stderr, self.output_log_limit))
+        return message
+
+
+class ShellSession(object):
+    """
+    A long-lived bash process that runs successive commands, avoiding the cost of starting a process and a shell for every command.
+    The working directory, environment variables and shell variables set by a command persist for the following commands.
+    Commands are run with eval, with stdin from /dev/null and the error output merged into the output.
+    The output of each command is delimited by a random marker line carrying its return code. A command exiting the shell fails and ends the session.
+    Commands are run one at a time. The session can be shared between threads but commands from different threads wait for each other.
+    Example:
+        with ShellSession(working_dir=repo_dir) as session:
+            for path in paths:
+                (rc, _) = session.exe_cmd('test -f {path}'.format(path=shell_escape(path)), raise_exception=False, log_level=logging.DEBUG)
+    """
+    def __init__(self, working_dir=None, env=None, shell='bash'):
+        """
+        Starts the shell. This does not work on Windows.
+        Args:
+            working_dir: The initial working directory of the shell (Optional)
+            env: Custom environment variables for the shell in place of the parent environment variables (Optional)
+            shell: The bash executable (Default: bash)
+        """
+        assert_linux()
+        self._marker = b'__BASEUTILS_' + binascii.hexlify(os.urandom(8)) + b'__'
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen([shell, '--noprofile', '--norc'], bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         cwd=working_dir, env=env)
+        _register_children(self._process, 'ShellSession: {shell}'.format(shell=shell))
+
+    def exe_cmd(self, cmd, obfuscate=None, log_level=logging.INFO, raise_exception=True, stream_log=False, output_log_limit=None, log_tag=None, redact=None):
+        """
+        Executes a command in the session. Logging and errors are as for exe_cmd.
+        Args:
+            cmd: The command to execute. A list of arguments is quoted and joined
+            obfuscate: A value to obfuscate in the logging (Optional)
+            log_level: The default logging level. Default: INFO. Setting to None will disable logging in this function
+            raise_exception: Whether to raise an exception if the command returns a non-zero return code (Default: True)
+            stream_log: When True, the process output will be logged as it arrives (Default: False)
+            output_log_limit: See exe_cmd (Optional)
+            log_tag: A tag to prefix all log lines for this command with (Optional)
+            redact: A Redactor whose secrets are masked in the logged command and the output. See exe_cmd (Optional)
+        Returns: A tuple of the return code and the output
+        """
+        stream = CommandStream(cmd, obfuscate=obfuscate, log_level=log_level, raise_exception=raise_exception, stream_log=stream_log, capture=OutputCapture(),
+                               log_output=not stream_log, output_log_limit=output_log_limit, log_tag=log_tag, redact=redact)
+        with self._lock:
+            if self._process.returncode is not None:
+                raise Exception('The shell session has been closed')
+            stream._log_start()
+            script = 'eval {cmd} < /dev/null 2>&1; printf \'\\n%s %d\\n\' {marker} $?\n'.format(cmd=_shell_quote(_cmd_to_str(cmd)), marker=self._marker.decode('ascii'))
+            try:
+                _write_all(self._process.stdin, script.encode('utf-8'))
+            except EnvironmentError:
+                self._close_exited()
+            stream.rc = self._read_output(stream)
+        stream._finish()
+        return (stream.rc, stream.output)
+
+    def _read_output(self, stream):
+        """
+        Reads a command's output up to its marker line, passing the output to the stream.
+        Returns: The return code from the marker line
+        """
+        marker = b'\n' + self._marker + b' '
+        decoder = _output_decoder()
+        buffer = b''
+        while True:
+            data = os.read(self._process.stdout.fileno(), DEFAULT_READ_SIZE)
+            if not data:
+                self._close_exited()
+            buffer += data
+            index = buffer.find(marker)
+            end = buffer.find(b'\n', index + len(marker)) if index != -1 else -1
+            if end != -1:
+                _decode_to_stream(stream, decoder, buffer[:index], final=True)
+                return int(buffer[index + len(marker):end])
+            # Anything that could be the start of the marker line is held back until more is read
+            safe = index if index != -1 else max(0, len(buffer) - len(marker) + 1)
+            _decode_to_stream(stream, decoder, buffer[:safe])
+            buffer = buffer[safe:]
+
+    def _close_exited(self):
+        """
+        Cleans up after the shell exits unexpectedly, eg. from a command calling exit, and raises an exception.
+        """
+        self.close()
+        raise Exception('The shell session exited with RC {rc}'.format(rc=self._process.returncode))
+
+    def close(self):
+        """
+        Ends the shell.
+        """
+        if self._process.returncode is not None:
+            return
+        try:
+            self._process.stdin.close()
+        except EnvironmentError:
+            pass  # the shell has already exited
+        self._process.stdout.close()
+        self._process.wait()
+        _unregister_children(self._process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _decode_to_stream(stream, decoder, data, final=False):
+    """
+    Decodes a block of command output and passes the text to a CommandStream.
+    """
+    stream._feed_output(decoder.decode(data, final=final), final=final)
+
+
+def start_spawn_server():
+    """
+    Starts a helper process that starts the commands of exe_cmd, iter_cmd and exe_cmds on behalf of this process, until stop_spawn_server is called.
+    The helper is forked from this process when this is called, so call this early, while this process is still small.
+    Starting a command then takes about as long as in a small process, no matter how large this process grows.
+    Python 3.10 and later already start most commands with vfork, which does not slow down as the process grows, so this mainly helps
+    older Python versions and commands that need a function run in the child before exec. Otherwise it adds around a millisecond per command.
+    Output and input are passed over pipes that this process creates, so commands behave as if started directly.
+    This requires Python 3 and does not work on Windows. The asyncio helpers are not affected.
+    Example:
+        start_spawn_server()
+        inventory = load_inventory()  # grows the process to several GB
+        for cluster in inventory:
+            exe_cmd('kubectl --context {c} get nodes'.format(c=cluster))
+    """
+    global _spawn_server
+    assert_linux()
+    with _spawn_server_lock:
+        if not _spawn_server:
+            _spawn_server = _SpawnServer()
+            atexit.register(stop_spawn_server)
+            logger.info('Started spawn server with pid {pid}'.format(pid=_spawn_server.pid))
+
+
+def stop_spawn_server():
+    """
+    Stops the helper process started by start_spawn_server. Commands are started directly again.
+    Commands already started by the helper are not affected.
+    """
+    global _spawn_server
+    with _spawn_server_lock:
+        if _spawn_server:
+            _spawn_server.stop()
+            _spawn_server = None
+
+
+class _SpawnServer(object):
+    """
+    The client side of the spawn server, holding the control socket of the forked helper process.
+    Each command gets its own socket pair. One end is passed to the helper over the control socket and carries the request
+    with the command's pipes, then the pid and finally the return code and resource usage.
+    """
+    def __init__(self):
+        (self._socket, server_socket) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._lock = threading.Lock()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._socket.close()
+            _serve_spawn_requests(server_socket)
+        server_socket.close()
+
+    def popen(self, cmd, working_dir=None, stdin=None, env=None, text=True, split_stderr=False, new_session=False, limits=None):
+        """
+        Starts a command through the helper. See _popen_cmd for the arguments.
+        Returns: A _SpawnedProcess
+        """
+        (request_socket, server_end) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        stdin_file = _stdin_file(stdin)
+        stdout = os.pipe()
+        stderr = os.pipe() if split_stderr else None
+        stdin_pipe = os.pipe() if stdin and not stdin_file else None
+        child_fds = [stdout[1]] + ([stderr[1]] if stderr else []) + ([stdin_pipe[0]] if stdin_pipe else [])
+        request = {'cmd': cmd, 'working_dir': working_dir or os.getcwd(), 'env': dict(os.environ) if env is None else env, 'split_stderr': split_stderr,
+                   'stdin': bool(stdin), 'new_session': new_session, 'limits': limits}
+        try:
+            with self._lock:
+                _send_message(self._socket, None, fds=[server_end.fileno()])
+            _send_message(request_socket, request, fds=child_fds + ([stdin_file.fileno()] if stdin_file else []))
+            (response, _) = _recv_message(request_socket)
+        finally:
+            server_end.close()
+            for fd in child_fds:
+                os.close(fd)
+        if response[0] == 'error':
+            request_socket.close()
+            for fd in [stdout[0]] + ([stderr[0]] if stderr else []) + ([stdin_pipe[1]] if stdin_pipe else []):
+                os.close(fd)
+            raise response[1]
+        return _SpawnedProcess(cmd, response[1], request_socket, stdout=_pipe_reader(stdout[0], text), stderr=_pipe_reader(stderr[0], text) if stderr else None,
+                               stdin=io.open(stdin_pipe[1], 'wb', 0) if stdin_pipe else None)
+
+    def stop(self):
+        """
+        Closes the control socket, which ends the helper process, and waits for it.
+        """
+        self._socket.close()
+        os.waitpid(self.pid, 0)
+
+
+class _SpawnedProcess(object):
+    """
+    A subprocess.Popen-like handle on a command started by the spawn server.
+    """
+    def __init__(self, args, pid, request_socket, stdout, stderr=None, stdin=None):
+        self.args = args
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stdin = stdin
+        self.returncode = None
+        self._socket = request_socket
+        self._rusage = None
+
+    def wait(self, timeout=None):
+        """
+        Waits for the command to exit. Raises subprocess.TimeoutExpired after the timeout.
+        Returns: The return code
+        """
+        self._wait_rusage(timeout=timeout)
+        return self.returncode
+
+    def poll(self):
+        """
+        Returns: The return code, or None if the command is still running
+        """
+        try:
+            return self.wait(timeout=0)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def _wait_rusage(self, timeout=None):
+        """
+        Waits for the helper to report that the command exited. See _wait_process.
+        Returns: The resource usage of the command
+        """
+        if self.returncode is None:
+            self._socket.settimeout(timeout)
+            try:
+                (response, _) = _recv_message(self._socket)
+            except socket.timeout:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            (_, self.returncode, self._rusage) = response
+            self._socket.close()
+        return self._rusage
+
+
+def _pipe_reader(fd, text):
+    """
+    Returns: A file object reading a command's output pipe, in text mode or unbuffered binary mode as subprocess.Popen(bufsize=0) opens it
+    """
+    return io.open(fd, 'r') if text else io.open(fd, 'rb', 0)
+
+
+def _serve_spawn_requests(control_socket):
+    """
+    The main loop of the spawn server's helper process. Receives the socket of each command and starts it from a thread, until the control socket is closed.
+    The helper process exits at the end rather than returning to the code that started it.
+    """
+    try:
+        signal.signal(signal.SIGINT, lambda signum, frame: None)  # Ctrl-C is left to the parent and the commands, which reset the handler on exec
+        while True:
+            (_, fds) = _recv_message(control_socket)
+            if not fds:
+                break
+            thread = threading.Thread(target=_serve_spawn_request, args=(socket.socket(fileno=fds[0]),))
+            thread.daemon = True
+            thread.start()
+    finally:
+        os._exit(0)
+
+
+def _serve_spawn_request(request_socket):
+    """
+    Starts a command in the spawn server's helper process, reports its pid, waits for it and reports its return code and resource usage.
+    """
+    with request_socket:
+        (request, fds) = _recv_message(request_socket)
+        stdout = fds.pop(0)
+        stderr = fds.pop(0) if request['split_stderr'] else subprocess.STDOUT
+        stdin = fds.pop(0) if request['stdin'] else None
+        try:
+            p = subprocess.Popen(request['cmd'], shell=not isinstance(request['cmd'], (list, tuple)), stdin=stdin, stdout=stdout, stderr=stderr,
+                                 cwd=request['working_dir'], env=request['env'], **_popen_kwargs(request['new_session'], request['limits']))
+        except Exception as e:
+            _send_message(request_socket, ('error', e))
+            return
+        finally:
+            for fd in (stdout, stderr, stdin):
+                if fd not in (None, subprocess.STDOUT):
+                    os.close(fd)
+        _send_message(request_socket, ('started', p.pid))
+        rusage = _wait_process(p)
+        _send_message(request_socket, ('exited', p.returncode, rusage))
+
+
+def _send_message(sock, message, fds=()):
+    """
+    Sends a length-prefixed pickled message over a Unix socket, with file descriptors attached.
+    """
+    data = pickle.dumps(message)
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('{n}i'.format(n=len(fds)), *fds))] if fds else []
+    sock.sendmsg([struct.pack('>L', len(data)) + data], ancillary)
+
+
+def _recv_message(sock):
+    """
+    Receives a message sent with _send_message.
+    Returns: A tuple of the message and a list of the attached file descriptors. The message is None and the list empty if the socket was closed
+    """
+    fd_size = struct.calcsize('i')
+    (data, ancillary, _, _) = sock.recvmsg(4, socket.CMSG_SPACE(3 * fd_size))
+    fds = []
+    for (level, kind, fd_data) in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.extend(struct.unpack('{n}i'.format(n=len(fd_data) // fd_size), fd_data[:len(fd_data) - len(fd_data) % fd_size]))
+    if not data:
+        return (None, fds)
+    data += _recv_exactly(sock, 4 - len(data))
+    return (pickle.loads(_recv_exactly(sock, struct.unpack('>L', data)[0])), fds)
+
+
+def _recv_exactly(sock, size):
+    """
+    Returns: The next size bytes from a socket
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('The spawn server connection was closed')
+        data += chunk
+    return data
+
+
+def _popen_cmd(cmd, working_dir=None, stdin=None, env=None, text=True, split_stderr=False, new_session=False, limits=None):
+    """
+    Starts a command for exe_cmd with its output and error output on one pipe, or on separate pipes.
+    Args:
+        cmd: The command to execute. A string is run by the shell and a list of arguments is executed directly
+        working_dir: The directory to execute the command from (Optional)
+        stdin: The standard input for the command. A real file is passed directly, otherwise a pipe is opened for it if set (Optional)
+        env: Custom environment variables for the command (Optional)
+        text: Whether the pipes are opened in text mode (Default: True)
+        split_stderr: Whether the error output has its own pipe (Default: False)
+        new_session: Whether to start the command in a new session, making it the leader of a new process group (Default: False)
+        limits: The _ChildLimits to apply to the command (Optional)
+    Returns: The subprocess.Popen object
+    """
+    if _spawn_server:
+        return _spawn_server.popen(cmd, working_dir=working_dir, stdin=stdin, env=env, text=text, split_stderr=split_stderr, new_session=new_session, limits=limits)
+    kwargs = _popen_kwargs(new_session, limits)
+    if text and os.name == 'nt' and sys.version_info[0] == 3:
+        kwargs['encoding'] = 'utf-8'  # the encoding is needed for windows & python3
+    return subprocess.Popen(cmd, shell=not isinstance(cmd, (list, tuple)), bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE if split_stderr else subprocess.STDOUT,
+                            stdin=_stdin_file(stdin) or (subprocess.PIPE if stdin else None), cwd=working_dir, universal_newlines=text, env=env, **kwargs)
+
+
+def _popen_kwargs(new_session=False, limits=None):
+    """
+    Returns: The optional subprocess.Popen arguments for starting a command in a new session and with limits. See _popen_cmd
+    """
+    kwargs = {'start_new_session': True} if new_session else {}
+    if limits:
+        kwargs['preexec_fn'] = _child_preexec(limits)
+    return kwargs
+
+
+_ChildLimits = collections.namedtuple('_ChildLimits', ['rlimits', 'nice', 'ionice', 'cpu_affinity'])
+
+
+def _child_limits(rlimits=None, nice=None, ionice=None, cpu_affinity=None):
+    """
+    Validates the resource limits and scheduling settings for a command. See exe_cmd for the arguments.
+    Returns: A _ChildLimits with the rlimits as a list of (resource, (soft, hard)) tuples and ionice as an I/O priority value, or None if nothing is set
+    """
+    if rlimits is None and nice is None and ionice is None and cpu_affinity is None:
+        return None
+    assert_linux()
+    rlimits = [(_rlimit_resource(key), tuple(value) if isinstance(value, (list, tuple)) else (value, value)) for (key, value) in (rlimits or {}).items()]
+    return _ChildLimits(rlimits, nice, _ioprio(ionice) if ionice is not None else None, sorted(cpu_affinity) if cpu_affinity is not None else None)
+
+
+def _rlimit_resource(key):
+    """
+    Returns: The resource module constant for a resource given as the constant or its name, with or without RLIMIT_
+    """
+    if not isinstance(key, str):
+        return key
+    name = key.upper() if key.upper().startswith('RLIMIT_') else 'RLIMIT_' + key.upper()
+    if not hasattr(resource, name):
+        raise Exception('Unknown resource limit: {key}'.format(key=key))
+    return getattr(resource, name)
+
+
+def _ioprio(ionice):
+    """
+    Returns: The I/O priority value for ioprio_set from an ionice class, or a tuple of the class and a priority from 0 to 7
+    """
+    (io_class, level) = tuple(ionice) if isinstance(ionice, (list, tuple)) else (ionice, None)
+    io_class = _IOPRIO_CLASSES.get(io_class, io_class)
+    if io_class not in _IOPRIO_CLASSES.values():
+        raise Exception('Unknown ionice class: {io_class}. Use one of: {classes}'.format(io_class=io_class, classes=', '.join(sorted(_IOPRIO_CLASSES))))
+    if level is None:
+        level = 0 if io_class == _IOPRIO_CLASSES['idle'] else 4
+    return (io_class << 13) | level
+
+
+def _child_preexec(limits):
+    """
+    Returns: A function applying _ChildLimits in the child process before exec, for subprocess.Popen(preexec_fn=...)
+    """
+    set_ioprio = _ioprio_setter() if limits.ionice is not None else None
+
+    def preexec():
+        for (resource_id, value) in limits.rlimits:
+            resource.setrlimit(resource_id, value)
+        if limits.nice:
+            os.nice(limits.nice)
+        if set_ioprio:
+            set_ioprio(limits.ionice)
+        if limits.cpu_affinity is not None:
+            os.sched_setaffinity(0, limits.cpu_affinity)
+    return preexec
+
+
+def _ioprio_setter():
+    """
+    Returns: A function setting the I/O priority of the calling process with the ioprio_set system call, which has no wrapper in os or libc.
+        The system call is looked up before the fork, as loading libraries in the child is not safe
+    """
+    number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        raise Exception('ionice is not supported on {machine}'.format(machine=platform.machine()))
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+
+    def set_ioprio(ioprio):
+        if syscall(number, 1, 0, ioprio) != 0:  # IOPRIO_WHO_PROCESS, with 0 for the calling process
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    return set_ioprio
+
+
+RunningCommand = collections.namedtuple('RunningCommand', ['pid', 'cmd', 'start_time', 'age'])
+
+
+def running_commands():
+    """
+    Lists the commands started by this library that are still running, including each stage of a pipeline and ShellSession shells.
+    Returns: A list of RunningCommand tuples of the pid, the command as logged, the time.time() it started at and its age in seconds, oldest first
+    Example:
+        for command in running_commands():
+            logger.info('{pid} has been running for {age:.0f}s: {cmd}'.format(**command._asdict()))
+    """
+    now = time.time()
+    with _running_children_lock:
+        children = sorted(_running_children.items(), key=lambda child: child[1][1])
+    return [RunningCommand(pid, cmd, start_time, now - start_time) for (pid, (cmd, start_time, _)) in children]
+
+
+def terminate_running_commands(grace_period=KILL_GRACE_PERIOD):
+    """
+    Terminates every command listed by running_commands, along with the processes they started.
+    They are sent SIGTERM and, after the commands exit or the grace period, the processes left are sent SIGKILL.
+    The commands are reaped by the threads that started them.
+    Args:
+        grace_period: The number of seconds to wait for the commands to exit after SIGTERM (Default: KILL_GRACE_PERIOD)
+    Returns: The number of commands signalled
+    """
+    with _running_children_lock:
+        children = [(pid, new_session) for (pid, (_, _, new_session)) in _running_children.items()]
+    targets = [_command_processes(pid, new_session) for (pid, new_session) in children]
+    listed = []
+    for (pids, process_groups) in targets:
+        _signal_processes(pids, signal.SIGTERM, process_groups)
+        if not process_groups:
+            listed.extend(_listed_processes(pids))
+    deadline = _monotonic() + grace_period
+    while _monotonic() < deadline and any(_child_running(pid) for (pid, _) in children):
+        time.sleep(0.05)
+    for (pids, process_groups) in targets:
+        if process_groups:
+            _signal_processes(pids, signal.SIGKILL, process_groups)  # a process group's id is not reused while it has members
+    _kill_listed_processes(listed)
+    return len(children)
+
+
+def install_child_cleanup(grace_period=KILL_GRACE_PERIOD, signals=None):
+    """
+    Terminates the running commands with terminate_running_commands at interpreter exit and when the process receives a termination signal,
+    so that cancelled jobs do not leave commands running. The previous signal handler is then called, or the default action taken.
+    Must be called from the main thread. Calling it again replaces the grace period and signals handled.
+    Args:
+        grace_period: The number of seconds to wait for the commands to exit after SIGTERM (Default: KILL_GRACE_PERIOD)
+        signals: The signals to handle (Optional, default: SIGTERM and SIGHUP)
+    Example:
+        install_child_cleanup(grace_period=5)
+    """
+    global _child_cleanup_grace_period
+    if _child_cleanup_grace_period is None:
+        atexit.register(_cleanup_at_exit)
+    _child_cleanup_grace_period = grace_period
+    for signum in (signals if signals is not None else (signal.SIGTERM, getattr(signal, 'SIGHUP', None))):
+        if signum is not None:
+            previous_handler = signal.getsignal(signum)
+            if isinstance(previous_handler, functools.partial) and previous_handler.func is _cleanup_signal_handler:
+                previous_handler = previous_handler.args[1]  # installed by an earlier call
+            signal.signal(signum, functools.partial(_cleanup_signal_handler, grace_period, previous_handler))
+
+
+def _cleanup_at_exit():
+    """
+    The atexit hook of install_child_cleanup.
+    """
+    terminate_running_commands(_child_cleanup_grace_period)
+
+
+def _cleanup_signal_handler(grace_period, previous_handler, signum, frame):
+    """
+    The signal handler of install_child_cleanup.
+    """
+    terminate_running_commands(grace_period)
+    if callable(previous_handler):
+        previous_handler(signum, frame)
+    elif previous_handler != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+def _register_children(p, cmd, new_session=False):
+    """
+    Adds the process, or each stage of a pipeline, to the running commands.
+    """
+    start_time = time.time()
+    with _running_children_lock:
+        for pid in _process_ids(p):
+            _running_children[pid] = (cmd, start_time, new_session)
+
+
+def _unregister_children(p):
+    """
+    Removes the process, or each stage of a pipeline, from the running commands.
+    """
+    with _running_children_lock:
+        for pid in _process_ids(p):
+            _running_children.pop(pid, None)
+
+
+def _process_ids(p):
+    """
+    Returns: The pids of a subprocess.Popen-like object, one for each stage of a _Pipeline
+    """
+    return [stage.pid for stage in p.processes] if isinstance(p, _Pipeline) else [p.pid]
+
+
+def _terminate_children(p, new_session=False, grace_period=KILL_GRACE_PERIOD):
+    """
+    Terminates a command that is no longer being read, along with the processes it started, waiting for up to the grace period before killing them.
+    Returns: The resource usage of the command if it exited and it is available. See _wait_process
+    """
+    if p.returncode is not None:
+        return None
+    if new_session:
+        return _kill_process_group(p, grace_period)
+    processes = _listed_processes([pid for stage_pid in _process_ids(p) for pid in _process_tree(stage_pid)])
+    _signal_processes([pid for (pid, _) in processes], signal.SIGTERM)
+    try:
+        return _wait_process(p, timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        return None
+    finally:
+        _kill_listed_processes(processes)
+
+
+def _command_processes(pid, new_session=False):
+    """
+    Returns: A tuple of the pids to signal to terminate a command and whether they are process groups.
+        The command's process group if it was started in a new session, otherwise the command and the processes it started
+    """
+    return ([pid], True) if new_session else (_process_tree(pid), False)
+
+
+def _process_tree(pid):
+    """
+    Returns: The pid followed by the pids of the processes it started and theirs in turn, from /proc. Only the pid where /proc is not available
+    """
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return [pid]
+    children = collections.defaultdict(list)
+    for name in names:
+        try:
+            with open('/proc/{name}/stat'.format(name=name)) as f:
+                children[int(f.read().rsplit(')', 1)[1].split()[1])].append(int(name))  # the command name in brackets may contain spaces
+        except (EnvironmentError, ValueError, IndexError):
+            pass  # not a process, or it has exited
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def _process_start_time(pid):
+    """
+    Returns: The start time of a process from /proc, which tells it apart from a later process reusing its pid. None if it has exited or /proc is not available
+    """
+    try:
+        with open('/proc/{pid}/stat'.format(pid=pid)) as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (EnvironmentError, ValueError, IndexError):
+        return None
+
+
+def _listed_processes(pids):
+    """
+    Returns: A list of (pid, start time) tuples for processes about to be sent SIGTERM, for _kill_listed_processes
+    """
+    return [(pid, _process_start_time(pid)) for pid in pids]
+
+
+def _kill_listed_processes(processes):
+    """
+    Sends SIGKILL to processes listed by _listed_processes that are still running once the grace period after SIGTERM is over.
+    A process that exited may have had its pid reused by another process since, so pids whose start time has changed are skipped.
+    """
+    _signal_processes([pid for (pid, start_time) in processes if _process_start_time(pid) == start_time], signal.SIGKILL)
+
+
+def _signal_processes(pids, signum, process_groups=False):
+    """
+    Sends a signal to processes, or process groups, ignoring those that have exited.
+    """
+    for pid in pids:
+        try:
+            if process_groups:
+                os.killpg(pid, signum)
+            else:
+                os.kill(pid, signum)
+        except OSError:
+            pass  # the process has exited
+
+
+def _child_running(pid):
+    """
+    Returns: Whether a command has not exited yet. The command is not reaped, as the thread that started it reaps it
+    """
+    try:
+        return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None
+    except (AttributeError, OSError):
+        pass  # no waitid, or the command was started by the spawn server
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _stdin_file(stdin):
+    """
+    Returns: The standard input if it is a file object with a file descriptor that can be passed to a command directly, otherwise None
+    """
+    try:
+        stdin.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None  # not a real file, such as a string or io.BytesIO
+    return stdin
+
+
+def _stdin_chunks(stdin):
+    """
+    Generator splitting the standard input for a command into bytes chunks for writing to its pipe.
+    Args:
+        stdin: A string, bytes, a file object or an iterable of string or bytes chunks
+    Returns: A generator of bytes
+    """
+    if isinstance(stdin, (bytes, type(u''))):
+        chunks = [stdin]
+    elif hasattr(stdin, 'read'):
+        chunks = iter(functools.partial(stdin.read, DEFAULT_READ_SIZE), stdin.read(0))
+    else:
+        chunks = stdin
+    for chunk in chunks:
+        yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+
+def _start_stdin_writer(pipe, stdin, on_error):
+    """
+    Starts a daemon thread writing the standard input for a command to its pipe and closing it.
+    Args:
+        pipe: The command's stdin pipe
+        stdin: The standard input. See _stdin_chunks
+        on_error: A function called with the exception if reading or writing the input fails, other than because the command exited
+    Returns: The thread
+    """
+    thread = threading.Thread(target=_write_stdin, args=(getattr(pipe, 'buffer', pipe), stdin, on_error))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _write_stdin(pipe, stdin, on_error):
+    """
+    Writes the standard input for a command to its binary pipe and closes it.
+    A command exiting without reading all of its input is not an error. Any other error is passed to on_error before the pipe is closed.
+    """
+    try:
+        for chunk in _stdin_chunks(stdin):
+            _write_all(pipe, chunk)
+    except EnvironmentError as e:
+        if e.errno not in (errno.EPIPE, errno.EINVAL):
+            on_error(e)
+    except Exception as e:
+        on_error(e)
+    finally:
+        try:
+            pipe.close()
+        except EnvironmentError:
+            pass  # the command has already exited
+
+
+def _write_all(pipe, data):
+    """
+    Writes all of the data to a pipe, which for an unbuffered pipe may take several writes.
+    """
+    view = memoryview(data)
+    while view:
+        written = pipe.write(view)
+        view = view[written:] if written is not None else view[:0]  # python2 file objects write everything and return None
+
+
+def _obfuscate_cmd(cmd, obfuscate=None):
+    """
+    Returns: A command as a string for logging, with the value to obfuscate replaced.
+        The value is replaced in each argument of a list before it is quoted, as quoting may change how the value appears
+    """
+    if not obfuscate:
+        return _cmd_to_str(cmd)
+    if isinstance(cmd, (list, tuple)):
+        return ' '.join('***'.join(_shell_quote(part) if part else '' for part in arg.split(obfuscate)) for arg in cmd)
+    return cmd.replace(obfuscate, '***')
+
+
+def _popen_pipeline(cmds, working_dir=None, stdin=None, env=None, text=True, new_session=False, limits=None):
+    """
+    Starts the stages of a pipeline for exe_pipeline, connecting the output of each stage to the input of the next.
+    The output of the last stage and the error output of every stage go to one pipe. See _popen_cmd for the arguments.
+    Returns: A _Pipeline
+    """
+    (output_fd, stage_output_fd) = os.pipe()
+    kwargs = _popen_kwargs(new_session, limits)
+    stages = []
+    stage_stdin = _stdin_file(stdin) or (subprocess.PIPE if stdin else None)
+    try:
+        for (index, cmd) in enumerate(cmds):
+            last = index == len(cmds) - 1
+            stages.append(subprocess.Popen(cmd, shell=not isinstance(cmd, (list, tuple)), stdin=stage_stdin, stdout=stage_output_fd if last else subprocess.PIPE,
+                                           stderr=stage_output_fd, cwd=working_dir, env=env, **kwargs))
+            if index:
+                stage_stdin.close()  # the pipe from the previous stage is now only held by the stage reading it
+            stage_stdin = stages[-1].stdout
+    except Exception:
+        os.close(output_fd)
+        for stage in stages:
+            for pipe in (stage.stdin, stage.stdout):
+                if pipe:
+                    pipe.close()  # the input of the first stage, and the output of the last stage started
+            stage.kill()
+            stage.wait()
+        raise
+    finally:
+        os.close(stage_output_fd)
+    return _Pipeline(stages, stdout=_pipe_reader(output_fd, text), stdin=stages[0].stdin)
+
+
+class _Pipeline(object):
+    """
+    A subprocess.Popen-like handle on the stages of a pipeline started by _popen_pipeline.
+    """
+    def __init__(self, processes, stdout, stdin=None):
+        self.processes = processes
+        self.args = [p.args for p in processes]
+        self.stdout = stdout
+        self.stderr = None
+        self.stdin = stdin
+        self.returncode = None
+        self.returncodes = None
+        self._rusages = [None] * len(processes)
+
+    def wait(self, timeout=None):
+        """
+        Waits for every stage to exit. Raises subprocess.TimeoutExpired after the timeout.
+        Returns: The return code of the last failing stage, or 0
+        """
+        self._wait_rusage(timeout=timeout)
+        return self.returncode
+
+    def _wait_rusage(self, timeout=None):
+        """
+        Waits for every stage to exit. See _wait_process.
+        Returns: The total resource usage of the stages, with the largest max RSS of any stage, or None where it is not available
+        """
+        deadline = None if timeout is None else _monotonic() + timeout
+        for (index, p) in enumerate(self.processes):
+            if p.returncode is None:
+                self._rusages[index] = _wait_process(p, timeout=None if deadline is None else max(0, deadline - _monotonic()))
+        self.returncodes = [p.returncode for p in self.processes]
+        self.returncode = next((rc for rc in reversed(self.returncodes) if rc), 0)
+        if None in self._rusages:
+            return None
+        return _PipelineRusage(sum(rusage.ru_utime for rusage in self._rusages), sum(rusage.ru_stime for rusage in self._rusages),
+                               max(rusage.ru_maxrss for rusage in self._rusages))
+
+
+_PipelineRusage = collections.namedtuple('_PipelineRusage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+
+def _cmd_to_str(cmd):
+    """
+    Returns: A command as a string for logging. A list of arguments is joined, quoting arguments where needed
+    """
+    if isinstance(cmd, (list, tuple)):
+        return ' '.join(_shell_quote(arg) for arg in cmd)
+    return cmd
+
+
+def _read_output(stream, read_size=None):
+    """
+    Generator reading a command's output pipe until it is closed.
+    Args:
+        stream: The pipe to read. Must be opened in text mode if read_size is not set, and in binary mode if it is
+        read_size: Read blocks of up to this many bytes with one system call each, decoding them as UTF-8 with universal newlines (Optional, default: read lines)
+    Returns: A generator of the output as it is read
+    """
+    if not read_size:
+        for line in iter(stream.readline, ''):
+            yield line
+        return
+    decoder = _output_decoder()
+    for data in iter(functools.partial(os.read, stream.fileno(), read_size), b''):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def _multiplex_output(pipes, read_size=DEFAULT_READ_SIZE, deadline=None, idle_timeout=None):
+    """
+    Generator reading several binary output pipes of a command at the same time, reading from whichever has output until all are closed.
+    Output is decoded as by _read_output with read_size.
+    Args:
+        pipes: The pipes to read
+        read_size: The maximum number of bytes to read from a pipe at a time (Default: DEFAULT_READ_SIZE)
+        deadline: A time.monotonic() value after which _OutputTimeout is raised (Optional)
+        idle_timeout: The number of seconds without output after which _OutputTimeout is raised (Optional)
+    Returns: A generator of (pipe, text) tuples
+    """
+    selector = selectors.DefaultSelector()
+    for pipe in pipes:
+        selector.register(pipe, selectors.EVENT_READ, _output_decoder())
+    try:
+        while selector.get_map():
+            events = selector.select(_select_timeout(deadline, idle_timeout))
+            if not events or (deadline is not None and _monotonic() >= deadline):
+                raise _OutputTimeout()
+            for (key, _) in events:
+                data = os.read(key.fd, read_size)
+                text = key.data.decode(data, final=not data)
+                if not data:
+                    selector.unregister(key.fileobj)
+                if text:
+                    yield (key.fileobj, text)
+    finally:
+        selector.close()
+
+
+def _select_timeout(deadline=None, idle_timeout=None):
+    """
+    Returns: The number of seconds to wait for output before a timeout is exceeded, or None to wait indefinitely
+    """
+    timeouts = [timeout for timeout in (idle_timeout, None if deadline is None else max(0, deadline - _monotonic())) if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+
+class _OutputTimeout(Exception):
+    """
+    Raised by _multiplex_output when a command exceeds its timeout or idle timeout.
+    """
+
+
+def _redact_output(output, redactor):
+    """
+    Generator masking secrets in the (pipe, text) tuples of a command's output, with a RedactorStream per pipe.
+    Args:
+        output: The generator of (pipe, text) tuples
+        redactor: The Redactor
+    Returns: A generator of (pipe, text) tuples. Text that could be the start of a secret is held back until the next text from the pipe
+    """
+    streams = {}
+    for (pipe, text) in output:
+        if pipe not in streams:
+            streams[pipe] = redactor.stream()
+        text = streams[pipe].feed(text)
+        if text:
+            yield (pipe, text)
+    for (pipe, stream) in streams.items():
+        text = stream.flush()
+        if text:
+            yield (pipe, text)
+
+
+def _split_lines(output):
+    """
+    Generator splitting the (pipe, text) tuples of _multiplex_output into a tuple per line.
+    Args:
+        output: The generator of (pipe, text) tuples
+    Returns: A generator of (pipe, line) tuples
+    """
+    line_buffers = collections.defaultdict(_LineBuffer)
+    for (pipe, text) in output:
+        for line in line_buffers[pipe].feed(text):
+            yield (pipe, line)
+    for (pipe, line_buffer) in line_buffers.items():
+        for line in line_buffer.flush():
+            yield (pipe, line)
+
+
+def _kill_process_group(p, grace_period=None):
+    """
+    Terminates a command started in its own process group, along with any processes it started.
+    The group is sent SIGTERM, then SIGKILL once the command has exited or after the grace period.
+    Args:
+        p: The subprocess.Popen object of the command, or a _Pipeline whose stages are each killed
+        grace_period: The number of seconds to wait for the command to exit after SIGTERM (Optional, default: KILL_GRACE_PERIOD)
+    Returns: The resource usage of the command if it exited within the grace period and it is available. See _wait_process
+    """
+    pids = _process_ids(p)
+    if not _signal_process_groups(pids, signal.SIGTERM):
+        return None  # the process groups no longer exist
+    rusage = None
+    try:
+        rusage = _wait_process(p, timeout=KILL_GRACE_PERIOD if grace_period is None else grace_period)
+    except subprocess.TimeoutExpired:
+        pass
+    _signal_process_groups(pids, signal.SIGKILL)
+    return rusage
+
+
+def _signal_process_groups(pids, signum):
+    """
+    Sends a signal to the process groups led by the given pids.
+    Returns: Whether any of the process groups still existed
+    """
+    signalled = False
+    for pid in pids:
+        try:
+            os.killpg(pid, signum)
+            signalled = True
+        except OSError:
+            pass  # every process in the group has exited
+    return signalled
+
+
+def _wait_process(p, timeout=None):
+    """
+    Waits for a command to exit and sets its returncode, collecting its resource usage with os.wait4 where available.
+    The resource usage covers the command and the processes it started and waited for.
+    Args:
+        p: The subprocess.Popen object of the command
+        timeout: The number of seconds to wait before raising subprocess.TimeoutExpired (Optional, default: no limit)
+    Returns: The resource.struct_rusage of the command, or None where os.wait4 is not available
+    """
+    if isinstance(p, (_SpawnedProcess, _Pipeline)):
+        return p._wait_rusage(timeout=timeout)
+    if not hasattr(os, 'wait4'):
+        p.wait(**({'timeout': timeout} if timeout is not None else {}))
+        return None
+    deadline = None if timeout is None else _monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            (pid, status, rusage) = os.wait4(p.pid, 0 if deadline is None else os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            p.returncode = 0  # the child was reaped elsewhere, e.g. with SIGCHLD ignored. subprocess also assumes success
+            return None
+        if pid:
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            return rusage
+        remaining = deadline - _monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(p.args, timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def _output_decoder():
+    """
+    Returns: An incremental decoder for command output read in blocks. Decodes UTF-8, replacing invalid bytes, and translates newlines as text mode pipes do
+    """
+    return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True)
+
+
+class _LineBuffer(object):
+    """
+    Splits output that arrives in arbitrary pieces into complete lines.
+    """
+    def __init__(self, limit=None):
+        """
+        Args:
+            limit: Keep at least this many of the last characters of the incomplete last line, and drop the rest once it is twice as long,
+                so that output without newlines does not grow the buffer (Optional, default: the whole line is kept)
+        """
+        self.limit = limit
+        self._partial_line = []
+        self._size = 0
+
+    def feed(self, data):
+        """
+        Adds output to the buffer.
+        Args:
+            data: The output to add
+        Returns: The list of lines completed by the output, each ending in a newline
+        """
+        if '\n' not in data:
+            self._partial_line.append(data)
+            self._size += len(data)
+            if self.limit and self._size > 2 * self.limit:
+                self._partial_line = [''.join(self._partial_line)[-self.limit:]]
+                self._size = self.limit
+            return []
+        lines = data.split('\n')
+        self._partial_line.append(lines[0])
+        lines[0] = ''.join(self._partial_line)
+        self._partial_line = [lines[-1]] if lines[-1] else []
+        self._size = len(lines[-1])
+        return [line + '\n' for line in lines[:-1]]
+
+    def pending(self):
+        """
+        Returns: The incomplete last line received so far
+        """
+        return ''.join(self._partial_line)
+
+    def flush(self):
+        """
+        Returns: A list holding the incomplete last line, or an empty list if there is none
+        """
+        line = self.pending()
+        self._partial_line = []
+        self._size = 0
+        return [line] if line else []
+
+
+class _TailCapture(object):
+    """
+    Keeps the last characters of output, for error reporting on output that may not be split into lines.
+    """
+    path = None
+
+    def __init__(self, size):
+        self.size = size
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.size:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self._chunks)[-self.size:]
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonStreamParser(object):
+    """
+    Parses JSON values from text that arrives in pieces, holding only the value being parsed.
+    Each value is parsed with json.JSONDecoder.raw_decode once enough of it has arrived. A parse of an incomplete value is retried only once
+    at least as much output again has arrived, so a value larger than a piece of output is parsed a number of times logarithmic in its size.
+    """
+    def __init__(self, chunks):
+        """
+        Args:
+            chunks: An iterator of the pieces of text
+        """
+        self._chunks = chunks
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def values(self):
+        """
+        Returns: A generator of the JSON values in the text, separated by optional whitespace
+        """
+        while self._peek():
+            yield self._decode()
+
+    def array_items(self, keys):
+        """
+        Args:
+            keys: The keys of the array in the top-level object. An empty list when the top-level value is the array
+        Returns: A generator of the items of the array
+        """
+        for key in keys:
+            self._find_key(key)
+        self._expect('[')
+        if self._peek() == ']':
+            return
+        while True:
+            yield self._decode()
+            if self._expect(',]') == ']':
+                return
+
+    def _find_key(self, key):
+        """
+        Moves past the object key, skipping the values of the keys before it.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            raise ValueError('JSON key not found: {key}'.format(key=key))
+        while True:
+            found = self._decode() == key
+            self._expect(':')
+            if found:
+                return
+            self._decode()
+            if self._expect(',}') == '}':
+                raise ValueError('JSON key not found: {key}'.format(key=key))
+
+    def _peek(self):
+        """
+        Returns: The next character that is not whitespace, or an empty string at the end of the text
+        """
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof:
+                return self._buffer[self._pos:self._pos + 1]
+            self._read(1)
+
+    def _expect(self, chars):
+        """
+        Moves past the next character, which must be one of chars.
+        Returns: The character
+        """
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of "{chars}" in JSON output, found: {found}'.format(chars=chars, found=self._buffer[self._pos:self._pos + 50] or 'end of output'))
+        self._pos += 1
+        return char
+
+    def _decode(self):
+        """
+        Returns: The next JSON value
+        """
+        self._peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buffer, self._pos)
+                if end < len(self._buffer) or self._eof:  # a number at the end could continue in the next output
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._read(len(self._buffer) - self._pos + 1)
+
+    def _read(self, size):
+        """
+        Adds at least size characters of text to the buffer, unless the text ends first, dropping the parsed text.
+        """
+        chunks = [self._buffer[self._pos:]]
+        received = 0
+        for chunk in self._chunks:
+            chunks.append(chunk)
+            received += len(chunk)
+            if received >= size:
+                break
+        else:
+            self._eof = True
+        self._buffer = ''.join(chunks)
+        self._pos = 0
+
+
+def _log_lines(lines, log_level, prefix=''):
+    """
+    Logs lines of streamed command output, skipping blank lines.
+    Args:
+        lines: The lines to log
+        log_level: The level to log at. None disables logging
+        prefix: A prefix for each logged line (Optional)
+    """
+    if log_level is None:
+        return
+    for line in lines:
+        if line.strip():
+            logger.log(log_level, prefix + line.rstrip())
+
+
+class OutputCapture(object):
+    """
+    Collects the output of a command for exe_cmd in linear time, optionally with bounded memory.
+    By default output is kept in memory as a list of chunks that is joined once at the end.
+    With max_memory, output beyond that many characters is spilled to a temporary file. getvalue() reads it back and deletes the file,
+    unless keep_file is set, in which case getvalue() only returns the last max_memory characters and the full output stays in the file at path.
+    Memory is therefore only bounded while the command runs unless keep_file or tail_lines is set, as getvalue() must otherwise return the whole output.
+    With tail_lines, only the last lines of output are kept, which is enough for error reporting on commands with large output.
+    Each of those lines is cut to its last characters, so memory also stays bounded for output without newlines.
+    Example:
+        with OutputCapture(max_memory=10485760, keep_file=True) as capture:
+            (rc, tail) = exe_cmd('kubectl get pods -o json', capture=capture)
+            if capture.path:
+                process_file(capture.path)
+    """
+    def __init__(self, max_memory=None, tail_lines=None, keep_file=False):
+        """
+        Constructor for the capture.
+        Args:
+            max_memory: The number of characters to hold in memory before spilling the output to a temporary file (Optional, default: no limit)
+            tail_lines: Keep only this many of the last lines of output, and only the last max_memory characters of each, or ITER_CMD_ERROR_SIZE without max_memory.
+                keep_file is ignored when this is set (Optional)
+            keep_file: Keep the spilled file for the caller to read from path rather than reading it back in getvalue().
+                The caller is responsible for calling close() (Default: False)
+        """
+        self.max_memory = max_memory
+        self.keep_file = keep_file
+        self.path = None
+        self._file = None
+        self._size = 0
+        self._chunks = collections.deque() if keep_file else []
+        self._lines = collections.deque(maxlen=tail_lines) if tail_lines else None
+        self._line_size = max_memory or ITER_CMD_ERROR_SIZE
+        self._line_buffer = _LineBuffer(limit=self._line_size if tail_lines else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, data):
+        """
+        Adds output to the capture.
+        Args:
+            data: The output to add
+        """
+        if self._lines is not None:
+            self._lines.extend(line[-self._line_size:] for line in self._line_buffer.feed(data))
+            return
+        if self._file:
+            self._file.write(data)
+            if not self.keep_file:
+                return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self.max_memory and self._size > self.max_memory:
+            self._spill()
+
+    def _spill(self):
+        """
+        Moves the in-memory output to a temporary file on first use, or drops the oldest in-memory output beyond max_memory when keep_file is set.
+        """
+        if not self._file:
+            fd, self.path = tempfile.mkstemp(prefix='baseutils-output-')
+            self._file = io.open(fd, 'w+', encoding='utf-8', newline='') if sys.version_info[0] >= 3 else io.open(fd, 'w+b')  # python2 output is str
+            self._file.writelines(self._chunks)
+            if not self.keep_file:
+                self._chunks = []
+                self._size = 0
+        while self._chunks and self._size - len(self._chunks[0]) >= self.max_memory:
+            self._size -= len(self._chunks.popleft())
+
+    def _keeps_all(self):
+        """
+        Returns: Whether getvalue() returns the whole output, rather than only its end
+        """
+        return self._lines is None and not (self.keep_file and self.max_memory)
+
+    def getvalue(self):
+        """
+        Returns the captured output. See the class description for what is returned in each mode.
+        """
+        if self._lines is not None:
+            lines = list(self._lines)
+            partial_line = self._line_buffer.pending()[-self._line_size:]
+            if partial_line and len(lines) == self._lines.maxlen:
+                lines.pop(0)  # the incomplete last line counts as one of the tail lines
+            return ''.join(lines) + partial_line
+        if self._file and not self.keep_file:
+            try:
+                self._file.seek(0)
+                self._chunks = [self._file.read()]
+            finally:
+                self.close()
+        elif self._file:
+            self._file.flush()
+        return ''.join(self._chunks)[-self.max_memory:] if self.keep_file and self.max_memory else ''.join(self._chunks)
+
+    def close(self):
+        """
+        Deletes the spilled file, if there is one.
+        """
+        if self._file:
+            try:
+                self._file.close()
+            finally:
+                os.remove(self.path)
+                self._file = None
+                self.path = None
+
+
+def _truncate_output(output, limit=None):
+    """
+    Cuts command output down to its first and last characters for logging.
+    Args:
+        output: The command output
+        limit: The maximum number of characters to keep. Half are taken from the start of the output and half from the end (Optional, default: no limit)
+    Returns: The output if it is within the limit, otherwise the beginning and end of the output separated by a truncation marker
+    """
+    if not limit or len(output) <= limit:
+        return output
+    head = limit // 2
+    tail = limit - head
+    return '{head}\n... [{count} characters truncated] ...\n{tail}'.format(head=output[:head], count=len(output) - limit, tail=output[len(output) - tail:])
 
 
 class local_lock:
@@ -1,9 +1,18 @@
+import gzip
+import io
+import json
 import logging
 import logmatic
 import os
 import shutil
+import signal
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+import warnings
 try:
     # python2
     from mock import patch
@@ -38,6 +47,217 @@ class TestUtils(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+    @unittest.skipIf(sys.version_info[0] < 3, 'Asynchronous logging requires Python 3')
+    def test_logger_async(self):
+        logger = logging.getLogger('test_logger_async')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmpdir, 'logfile')
+            baseutils.configure_logger(logger, file_path=file_path, async_logging=True)
+            self.assertIsInstance(logger.handlers[0], logging.handlers.QueueHandler)
+            listener = logger.handlers[0].listener
+            self.assertIsInstance(listener.handlers[0], logging.handlers.RotatingFileHandler)
+            listener.handlers[0].acquire()  # blocks the listener thread on the first record
+            try:
+                for i in range(100):
+                    logger.info('record %d', i)
+                self.assertGreaterEqual(baseutils.get_logger_queue_depth(logger), 99)
+            finally:
+                listener.handlers[0].release()
+            formatter = logging.Formatter('%(levelname)s %(message)s')
+            baseutils.replace_logger_formatter(logger, formatter)
+            self.assertEqual(formatter, listener.handlers[0].formatter)
+            listener.stop()
+            self.assertEqual(0, baseutils.get_logger_queue_depth(logger))
+            with open(file_path) as f:
+                self.assertEqual(100, len(f.readlines()))
+            listener.handlers[0].close()
+            logger.handlers = []
+            with patch('atexit.register') as register, patch.object(baseutils.baseutils, '_queue_listeners', None):
+                for _ in range(2):
+                    baseutils.configure_logger(logger, file_path=file_path, async_logging=True)
+                self.assertEqual(1, register.call_count)
+                baseutils.baseutils._stop_queue_listeners()
+                self.assertEqual(set(), baseutils.baseutils._queue_listeners)
+            for handler in logger.handlers:
+                handler.listener.handlers[0].close()
+        finally:
+            logger.handlers = []
+            shutil.rmtree(tmpdir)
+
+    def test_size_rotating_file_handler(self):
+        logger = logging.getLogger('test_size_rotating_file_handler')
+        logger.propagate = False
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmpdir, 'logfile')
+            handler = baseutils.SizeRotatingFileHandler(file_path, backupCount=2, maxBytes=1000)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            for i in range(60):
+                logger.warning('%039d', i)
+            handler.close()
+            self.assertEqual(['logfile', 'logfile.1', 'logfile.2'], sorted(os.listdir(tmpdir)))
+            for name in os.listdir(tmpdir):
+                self.assertLess(os.path.getsize(os.path.join(tmpdir, name)), 1000)
+            with open(file_path) as f:
+                self.assertEqual('{0:039d}\n'.format(59), f.readlines()[-1])
+            logger.handlers = []
+            handler = baseutils.SizeRotatingFileHandler(os.path.join(tmpdir, 'utf8'), backupCount=1, maxBytes=1000, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            for i in range(30):
+                logger.warning(u'\u00e9' * 39)
+            handler.close()
+            for name in ('utf8', 'utf8.1'):
+                self.assertLess(os.path.getsize(os.path.join(tmpdir, name)), 1000)
+            if os.path.exists(os.devnull):
+                handler = baseutils.SizeRotatingFileHandler(os.devnull, backupCount=1, maxBytes=10)
+                handler.emit(logging.makeLogRecord({'msg': 'x' * 20}))
+                handler.emit(logging.makeLogRecord({'msg': 'x' * 20}))
+                handler.close()
+                self.assertFalse(os.path.exists(os.devnull + '.1'))
+        finally:
+            logger.handlers = []
+            shutil.rmtree(tmpdir)
+
+    def test_compressing_rotating_file_handler(self):
+        logger = logging.getLogger('test_compressing_rotating_file_handler')
+        logger.propagate = False
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmpdir, 'logfile')
+            handler = baseutils.CompressingRotatingFileHandler(file_path, maxBytes=1000, max_total_bytes=1500)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            for i in range(500):
+                logger.warning('%039d', i)
+            handler.close()
+            rotated_files = sorted(name for name in os.listdir(tmpdir) if name != 'logfile')
+            self.assertTrue(rotated_files)
+            self.assertTrue(all(name.endswith('.gz') for name in rotated_files))
+            self.assertLessEqual(sum(os.path.getsize(os.path.join(tmpdir, name)) for name in rotated_files), 500)
+            with gzip.open(os.path.join(tmpdir, rotated_files[-1]), 'rb') as f:
+                lines = f.readlines()
+            with open(file_path) as f:
+                self.assertEqual(int(lines[-1]) + 1, int(f.readline()))
+        finally:
+            logger.handlers = []
+            shutil.rmtree(tmpdir)
+
+    def _log_shared_worker_records(self, logger, file_path):
+        """
+        Logs records from a forked worker of test_logger_shared.
+        Returns: The exit status for the worker, 1 if it failed
+        """
+        try:
+            baseutils.configure_logger(logger, file_path=file_path, shared=True)
+            self.assertEqual(1, len(logger.handlers))
+            self.assertIsInstance(logger.handlers[0], logging.handlers.SocketHandler)
+            for i in range(100):
+                logger.info('worker record %d', i)
+            logger.handlers[0].close()
+        except BaseException:
+            return 1
+        return 0
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'Shared logging requires Python 3')
+    def test_logger_shared(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        logger = logging.getLogger('test_logger_shared')
+        logger.propagate = False
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmpdir, 'logfile')
+            baseutils.configure_logger(logger, file_path=file_path, formatter=logging.Formatter('%(process)d %(message)s'), shared=True)
+            aggregator = logger.handlers[0].aggregator
+            pids = []
+            for _ in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    os._exit(self._log_shared_worker_records(logger, file_path))
+                pids.append(pid)
+            for pid in pids:
+                self.assertEqual(0, os.waitpid(pid, 0)[1])
+            logger.info('parent record')
+            for _ in range(100):
+                with open(file_path) as f:
+                    lines = f.readlines()
+                if len(lines) == 401:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(401, len(lines))
+            self.assertEqual(5, len(set(line.split()[0] for line in lines)))
+            aggregator.stop()
+            self.assertNotIn(os.path.abspath(file_path), os.environ.get('BASEUTILS_LOG_AGGREGATORS', ''))
+            # A forked worker exiting normally runs the atexit hooks it inherited, including the aggregator's
+            script = ('import baseutils, logging, os, sys\n'
+                      'logger = logging.getLogger("shared")\n'
+                      'baseutils.configure_logger(logger, file_path=sys.argv[1], shared=True)\n'
+                      'pid = os.fork()\n'
+                      'if pid == 0:\n'
+                      '    baseutils.configure_logger(logger, file_path=sys.argv[1], shared=True)\n'
+                      '    logger.info("worker record")\n'
+                      '    sys.exit(0)\n'
+                      'sys.exit(os.waitpid(pid, 0)[1])\n')
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+            p = subprocess.Popen([sys.executable, '-c', script, os.path.join(tmpdir, 'forked')], env=env)
+            try:
+                self.assertEqual(0, p.wait(timeout=30))
+            finally:
+                if p.returncode is None:
+                    p.kill()
+                    p.wait()
+            with open(os.path.join(tmpdir, 'forked')) as f:
+                self.assertIn('worker record', f.read())
+        finally:
+            for handler in logger.handlers:
+                handler.close()
+            logger.handlers = []
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.environ.get('BASEUTILS_BENCHMARK'), 'Set BASEUTILS_BENCHMARK=1 to run benchmarks')
+    def test_benchmark_size_rotating_file_handler(self):
+        records = 200000
+        formatter = logging.Formatter('[%(asctime)-15s] [%(module)s] [%(funcName)s] %(levelname)s %(message)s')
+        record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'Command output: %s', ('x' * 100,), None)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for handler_class in (logging.handlers.RotatingFileHandler, baseutils.SizeRotatingFileHandler):
+                handler = handler_class(os.path.join(tmpdir, handler_class.__name__), backupCount=10, maxBytes=52428800)
+                handler.setFormatter(formatter)
+                start = time.time()
+                for _ in range(records):
+                    handler.handle(record)
+                elapsed = time.time() - start
+                handler.close()
+                sys.stderr.write('\n{name}: {rate:.0f} records/sec'.format(name=handler_class.__name__, rate=records / elapsed))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch.dict(os.environ, {'tower_job_id': '1234'})
+    def test_json_formatter(self):
+        formatter = baseutils.JsonFormatter(extra={'app': 'unittests'})
+        record = logging.LogRecord('unittests', logging.WARNING, __file__, 10, 'hello %s', ('world',), None)
+        record.custom_field = 'custom'
+        log_record = json.loads(formatter.format(record))
+        logmatic_record = json.loads(logmatic.JsonFormatter().format(record))
+        self.assertTrue(set(logmatic_record).issubset(set(log_record)))
+        self.assertEqual(logmatic_record['asctime'], log_record['asctime'])
+        self.assertEqual(log_record['asctime'], log_record['timestamp'])
+        self.assertEqual('hello world', log_record['message'])
+        self.assertEqual('custom', log_record['custom_field'])
+        self.assertEqual('1234', log_record['tower_job_id'])
+        self.assertEqual('unittests', log_record['app'])
+        self.assertEqual(os.getpid(), log_record['pid'])
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            record = logging.LogRecord('unittests', logging.ERROR, __file__, 10, 'error', (), sys.exc_info())
+        self.assertIn('ValueError: failure', json.loads(formatter.format(record))['exc_info'])
+
     def test_discover_github_latest_patch_version(self):
         # As newer versions of K8 are added, we have to change the versions used below
         release_url = 'https://api.github.com/repos/kubernetes/kubernetes/releases'
@@ -69,6 +289,639 @@ class TestUtils(unittest.TestCase):
         e_msg = str(context.exception)
         self.assertFalse('is not recognized' in e_msg or 'not found' in e_msg)
 
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_exe_cmd_output_log_limit(self):
+        with self.assertLogs('baseutils.baseutils', level=logging.DEBUG) as logs:
+            (rc, output) = baseutils.exe_cmd('echo 0123456789abcdefghij', output_log_limit=10)
+        self.assertEqual('0123456789abcdefghij\n', output)
+        self.assertIn('Command output: 01234\n... [11 characters truncated] ...\nghij\n', '\n'.join(logs.output))
+        with self.assertLogs('baseutils.baseutils', level=logging.DEBUG) as logs:
+            baseutils.exe_cmd('echo value', log_level=logging.DEBUG)
+        self.assertIn('DEBUG:baseutils.baseutils:Command output: value\n', logs.output)
+        with self.assertLogs('baseutils.baseutils', level=logging.DEBUG) as logs:
+            baseutils.exe_cmd('echo value', log_level=None)
+        self.assertFalse([line for line in logs.output if 'Command output' in line])
+        with self.assertRaises(Exception) as context:
+            baseutils.exe_cmd('echo 0123456789abcdefghij; exit 1', output_log_limit=10)
+        self.assertIn('[11 characters truncated]', str(context.exception))
+
+    def test_output_capture(self):
+        capture = baseutils.OutputCapture(max_memory=10)
+        for i in range(10):
+            capture.write('line {i}\n'.format(i=i))
+        spill_path = capture.path
+        self.assertTrue(os.path.isfile(spill_path))
+        self.assertEqual(''.join('line {i}\n'.format(i=i) for i in range(10)), capture.getvalue())
+        self.assertFalse(os.path.exists(spill_path))
+        capture = baseutils.OutputCapture(max_memory=10)
+        capture.write('line 1\nline 2\n')
+        spill_path = capture.path
+        with patch.object(capture._file, 'read', side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                capture.getvalue()
+        self.assertFalse(os.path.exists(spill_path))
+        with baseutils.OutputCapture(max_memory=10, keep_file=True) as capture:
+            for i in range(10):
+                capture.write('line {i}\n'.format(i=i))
+            self.assertEqual(' 8\nline 9\n', capture.getvalue())
+            with open(capture.path) as f:
+                self.assertEqual(''.join('line {i}\n'.format(i=i) for i in range(10)), f.read())
+            spill_path = capture.path
+        self.assertFalse(os.path.exists(spill_path))
+        capture = baseutils.OutputCapture(tail_lines=2)
+        for data in ('a\nb', 'b', '\nc\nd', 'd'):
+            capture.write(data)
+        self.assertEqual('c\ndd', capture.getvalue())
+        # Only the end of each line is kept, however long the line
+        capture = baseutils.OutputCapture(tail_lines=2, max_memory=3)
+        for data in ['x'] * 1000 + ['abcd\nx', 'yz']:
+            capture.write(data)
+        self.assertEqual('cd\nxyz', capture.getvalue())
+        self.assertLessEqual(sum(len(chunk) for chunk in capture._line_buffer._partial_line), 6)
+        if os.name != 'nt':
+            self.assertEqual((0, '3\n4\n'), baseutils.exe_cmd('seq 1 4', capture=baseutils.OutputCapture(tail_lines=2)))
+            with self.assertRaises(Exception) as context:
+                baseutils.exe_cmd('seq 1 1000; exit 1', capture=baseutils.OutputCapture(tail_lines=1))
+            self.assertTrue(str(context.exception).endswith('Output: 1000\n'))
+            stream = baseutils.iter_cmd('head -c 1000000 /dev/zero | tr "\\0" x', read_size=1000)
+            self.assertEqual(1000000, sum(len(data) for data in stream))
+            self.assertEqual('x' * baseutils.ITER_CMD_ERROR_SIZE, stream.output)
+            self.assertEqual((0, 'value\n' * 1000), baseutils.exe_cmd('seq 1000 | sed "s/.*/value/"', capture=baseutils.OutputCapture(max_memory=100)))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_exe_cmd_read_size(self):
+        self.assertEqual((0, 'value\n'), baseutils.exe_cmd('echo value', read_size=baseutils.DEFAULT_READ_SIZE))
+        if os.name != 'nt':
+            self.assertEqual((0, 'value'), baseutils.exe_cmd('less', stdin='value', read_size=4))
+            with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                (rc, output) = baseutils.exe_cmd('printf "line one\\nline two\\n\\nline three"', stream_log=True, read_size=3)
+            self.assertEqual('line one\nline two\n\nline three', output)
+            self.assertEqual(['line one', 'line two', 'line three'], [line.split(':', 2)[2] for line in logs.output if ':line ' in line])
+
+    @unittest.skipUnless(os.environ.get('BASEUTILS_BENCHMARK'), 'Set BASEUTILS_BENCHMARK=1 to run benchmarks')
+    def test_benchmark_exe_cmd_read_size(self):
+        size = 104857600
+        logger = logging.getLogger('baseutils.baseutils')
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            for read_size in (None, baseutils.DEFAULT_READ_SIZE):
+                start = time.time()
+                (rc, output) = baseutils.exe_cmd('yes | head -c {size}'.format(size=size), read_size=read_size)
+                elapsed = time.time() - start
+                self.assertEqual(size, len(output))
+                sys.stderr.write('\nread_size={read_size}: {rate:.1f} MB/s'.format(read_size=read_size, rate=size / elapsed / 1048576))
+        finally:
+            logger.setLevel(level)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_exe_cmd_argv(self):
+        self.assertEqual((0, 'value\n'), baseutils.exe_cmd([sys.executable, '-c', 'print("value")']))
+        with self.assertRaises(OSError):
+            baseutils.exe_cmd(['fake_cmd'])
+        if os.name != 'nt':
+            with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                self.assertEqual((0, '$HOME it\'s secret\n'), baseutils.exe_cmd(['echo', '$HOME', "it's", 'secret'], obfuscate='secret'))
+            self.assertIn('INFO:baseutils.baseutils:Executing: echo \'$HOME\' \'it\'"\'"\'s\' ***', logs.output)
+            with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                self.assertEqual((0, "--password=it's secret\n"), baseutils.exe_cmd(['echo', "--password=it's secret"], obfuscate="it's secret"))
+            self.assertIn('INFO:baseutils.baseutils:Executing: echo --password=***', logs.output)
+            self.assertFalse([line for line in logs.output if 'Executing' in line and 'secret' in line])
+            self.assertEqual((0, 'value'), baseutils.exe_cmd(['cat'], stdin='value'))
+            self.assertEqual((3, ''), baseutils.exe_cmd(['sh', '-c', 'exit 3'], raise_exception=False))
+            tmpdir = tempfile.mkdtemp()
+            try:
+                self.assertEqual((0, os.path.realpath(tmpdir) + '\n'), baseutils.exe_cmd(['pwd', '-P'], working_dir=tmpdir))
+            finally:
+                shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'split_stderr requires Python 3')
+    def test_exe_cmd_split_stderr(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        self.assertEqual((0, 'out\n', 'err\n'), baseutils.exe_cmd('echo out; echo err >&2', split_stderr=True))
+        (rc, output, stderr) = baseutils.exe_cmd('head -c 1000000 /dev/zero | tr "\\0" e >&2; head -c 1000000 /dev/zero | tr "\\0" o', split_stderr=True, read_size=4096)
+        self.assertEqual(('o' * 1000000, 'e' * 1000000), (output, stderr))
+        with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+            baseutils.exe_cmd('echo out; echo err >&2', split_stderr=True, stream_log=True)
+        self.assertIn('INFO:baseutils.baseutils:out', logs.output)
+        self.assertIn('INFO:baseutils.baseutils:err', logs.output)
+        with self.assertRaises(Exception) as context:
+            baseutils.exe_cmd('echo out; echo failure >&2; exit 1', split_stderr=True)
+        self.assertTrue(str(context.exception).endswith('. Output: out\n. Error output: failure\n'))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'Timeouts require Python 3')
+    def test_exe_cmd_timeout(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        start = time.time()
+        with self.assertRaises(Exception) as context:
+            baseutils.exe_cmd('echo partial; sleep 30', timeout=1)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn('Timed out after 1 seconds. RC: -15. Output: partial\n', str(context.exception))
+        (rc, output) = baseutils.exe_cmd('echo partial; sleep 30', idle_timeout=0.5, raise_exception=False)
+        self.assertEqual((-15, 'partial\n'), (rc, output))
+        self.assertEqual((0, 'done\n'), baseutils.exe_cmd('sleep 0.2; echo done', timeout=10, idle_timeout=5))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # The background sleep holds no output pipe, so only the process group kill can stop it before it touches the file
+            baseutils.exe_cmd('(sleep 2; touch orphan) > /dev/null & sleep 30', timeout=0.5, raise_exception=False, working_dir=tmpdir)
+            time.sleep(2.5)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'orphan')))
+        finally:
+            shutil.rmtree(tmpdir)
+        stream = baseutils.iter_cmd('echo line1; echo line2; sleep 30', idle_timeout=0.5, raise_exception=False)
+        self.assertEqual(['line1\n', 'line2\n'], list(stream))
+        self.assertEqual('No output for 0.5 seconds', stream.timed_out)
+
+    def test_exe_cmd_stdin_stream(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        self.assertEqual((0, 'value'), baseutils.exe_cmd('cat', stdin=b'value'))
+        self.assertEqual((0, 'abc'), baseutils.exe_cmd('cat', stdin=(chunk for chunk in ['a', b'b', 'c'])))
+        self.assertEqual((0, 'value'), baseutils.exe_cmd('cat', stdin=io.BytesIO(b'value')))
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write(b'line\n' * 100000)
+            stdin.seek(0)
+            self.assertEqual((0, '100000\n'), baseutils.exe_cmd('wc -l', stdin=stdin))
+        # The output is read while input is written, so more of both than fits in the pipes does not deadlock
+        (rc, output) = baseutils.exe_cmd('cat', stdin=('x' * 65536 for _ in range(100)))
+        self.assertEqual(65536 * 100, len(output))
+        self.assertEqual((0, ''), baseutils.exe_cmd('true', stdin=('x' * 65536 for _ in range(100))))
+        # An error reading the input is raised rather than the command seeing its input end early
+        with self.assertRaises(ValueError) as context:
+            baseutils.exe_cmd('cat; echo finished', stdin=self._failing_stdin())
+        self.assertEqual('stdin failed', str(context.exception))
+        self.assertEqual([], baseutils.running_commands())
+
+    def _failing_stdin(self):
+        yield b'line1\n'
+        time.sleep(0.2)
+        raise ValueError('stdin failed')
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_exe_cmd_return_result(self):
+        result = baseutils.exe_cmd('echo value', return_result=True)
+        self.assertIsInstance(result, baseutils.CommandResult)
+        self.assertEqual((0, 'value\n'), tuple(result))
+        self.assertGreater(result.wall_time, 0)
+        if os.name != 'nt':
+            with self.assertLogs('baseutils.baseutils', level=logging.DEBUG) as logs:
+                result = baseutils.exe_cmd([sys.executable, '-c', 'x = bytearray(100000000); sum(range(1000000))'], return_result=True)
+            self.assertGreater(result.max_rss, 100000000)
+            self.assertGreater(result.user_time + result.system_time, 0)
+            self.assertTrue(any('Command resources: CommandResult(rc=0' in line for line in logs.output))
+            (rc, output, stderr) = baseutils.exe_cmd('echo out; echo err >&2; exit 2', split_stderr=True, raise_exception=False, return_result=True)
+            self.assertEqual((2, 'out\n', 'err\n'), (rc, output, stderr))
+            result = baseutils.exe_cmd('sleep 30', timeout=0.5, raise_exception=False, return_result=True)
+            self.assertEqual(-15, result.rc)
+            self.assertIsNotNone(result.user_time)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_shell_session(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with baseutils.ShellSession(working_dir=tmpdir) as session:
+                self.assertEqual((0, ''), session.exe_cmd('mkdir sub && cd sub && export VALUE=secret'))
+                self.assertEqual((0, os.path.join(os.path.realpath(tmpdir), 'sub') + '\nsecret'), session.exe_cmd('pwd -P; printf $VALUE'))
+                self.assertEqual((3, 'out\nerr\n'), session.exe_cmd('echo out; echo err >&2; (exit 3)', raise_exception=False))
+                self.assertEqual((0, 'a b\n'), session.exe_cmd(['echo', 'a b']))
+                self.assertEqual((0, '300000'), session.exe_cmd('printf %s {arg} | tr -d "\\n" | wc -c | tr -d " \\n"'.format(arg='x' * 300000), log_level=None))
+                self.assertEqual(2, session.exe_cmd('echo "unterminated', raise_exception=False)[0])
+                self.assertEqual((0, ''), session.exe_cmd('cat'))
+                (rc, output) = session.exe_cmd('head -c 1000000 /dev/zero | tr "\\0" x')
+                self.assertEqual('x' * 1000000, output)
+                with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                    with self.assertRaises(Exception) as context:
+                        session.exe_cmd('echo secret; false', obfuscate='secret')
+                self.assertIn('INFO:baseutils.baseutils:Executing: echo ***; false', logs.output)
+                self.assertIn('RC: 1. Output: secret\n', str(context.exception))
+                with self.assertRaises(Exception):
+                    session.exe_cmd('exit 4')
+                with self.assertRaises(Exception):
+                    session.exe_cmd('true')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.environ.get('BASEUTILS_BENCHMARK'), 'Set BASEUTILS_BENCHMARK=1 to run benchmarks')
+    def test_benchmark_shell_session(self):
+        count = 500
+        logger = logging.getLogger('baseutils.baseutils')
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            start = time.time()
+            for _ in range(count):
+                baseutils.exe_cmd('test -d /')
+            sys.stderr.write('\nexe_cmd: {rate:.0f} commands/sec'.format(rate=count / (time.time() - start)))
+            with baseutils.ShellSession() as session:
+                start = time.time()
+                for _ in range(count):
+                    session.exe_cmd('test -d /')
+                sys.stderr.write('\nShellSession: {rate:.0f} commands/sec'.format(rate=count / (time.time() - start)))
+        finally:
+            logger.setLevel(level)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_command_cache(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = baseutils.CommandCache(ttl=60, max_size=2)
+            cmd = 'echo run >> runs; wc -l < runs'
+            self.assertEqual((0, '1\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache))
+            with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                self.assertEqual((0, '1\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache, log_tag='tag'))
+            self.assertEqual(['INFO:baseutils.baseutils:[tag] Using cached output of: ' + cmd], logs.output)
+            self.assertEqual((0, '2\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache, env={'KEY': 'value'}))
+            self.assertEqual((0, '3\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache, stdin='input'))
+            # The least recently used entry has been dropped
+            self.assertEqual((0, '4\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache))
+            self.assertEqual((1, ''), baseutils.exe_cmd('echo run >> runs; false', working_dir=tmpdir, cache=cache, raise_exception=False))
+            self.assertEqual((1, ''), baseutils.exe_cmd('echo run >> runs; false', working_dir=tmpdir, cache=cache, raise_exception=False))
+            self.assertEqual((0, '7\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, stdin=io.BytesIO(b'input'), cache=cache))
+            cache = baseutils.CommandCache(ttl=0.5, path=os.path.join(tmpdir, 'cache'))
+            self.assertEqual((0, '8\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache))
+            result = baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=baseutils.CommandCache(path=os.path.join(tmpdir, 'cache')), return_result=True)
+            self.assertEqual((0, '8\n'), tuple(result))
+            time.sleep(0.6)
+            self.assertEqual((0, '9\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache))
+            cache.clear()
+            self.assertEqual([], os.listdir(os.path.join(tmpdir, 'cache')))
+            cache = baseutils.CommandCache()
+            with patch.dict(os.environ, {'KUBECONFIG': 'first'}):
+                self.assertEqual((0, 'first\n'), baseutils.exe_cmd('echo $KUBECONFIG', cache=cache))
+            with patch.dict(os.environ, {'KUBECONFIG': 'second'}):
+                self.assertEqual((0, 'second\n'), baseutils.exe_cmd('echo $KUBECONFIG', cache=cache))
+                result = baseutils.exe_cmd('echo $KUBECONFIG', cache=cache, return_result=True)
+                result.output = 'changed'
+                self.assertEqual((0, 'second\n'), baseutils.exe_cmd('echo $KUBECONFIG', cache=cache))
+            self.assertEqual((0, '10\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache, capture=baseutils.OutputCapture(tail_lines=1)))
+            self.assertEqual((0, '11\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir, cache=cache))
+            slow_cmd = 'trap "exit 0" TERM; echo run >> runs; sleep 30 & wait'
+            for _ in range(2):
+                self.assertEqual(0, baseutils.exe_cmd(slow_cmd, working_dir=tmpdir, cache=cache, timeout=0.5, raise_exception=False)[0])
+            self.assertEqual((0, '14\n'), baseutils.exe_cmd(cmd, working_dir=tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'The spawn server requires Python 3')
+    def test_spawn_server(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        baseutils.start_spawn_server()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertEqual((0, 'value\n'), baseutils.exe_cmd('echo value'))
+            with patch.dict(os.environ, {'VALUE': 'late'}):
+                self.assertEqual((0, 'late\n' + os.path.realpath(tmpdir) + '\n'), baseutils.exe_cmd('echo $VALUE; pwd -P', working_dir=tmpdir))
+            self.assertEqual((0, 'value'), baseutils.exe_cmd('cat', stdin='value'))
+            self.assertEqual((0, 'out\n', 'err\n'), baseutils.exe_cmd('echo out; echo err >&2', split_stderr=True))
+            self.assertEqual(['1\n', '2\n'], list(baseutils.iter_cmd('seq 2')))
+            result = baseutils.exe_cmd('exit 3', raise_exception=False, return_result=True)
+            self.assertEqual(3, result.rc)
+            self.assertIsNotNone(result.user_time)
+            self.assertEqual(-15, baseutils.exe_cmd('sleep 30', timeout=0.5, raise_exception=False)[0])
+            with self.assertRaises(OSError):
+                baseutils.exe_cmd(['fake_cmd'])
+            self.assertEqual([(0, '{i}\n'.format(i=i)) for i in range(10)], baseutils.exe_cmds(['echo {i}'.format(i=i) for i in range(10)], max_workers=5))
+        finally:
+            baseutils.stop_spawn_server()
+            shutil.rmtree(tmpdir)
+        self.assertEqual((0, 'value\n'), baseutils.exe_cmd('echo value'))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'exe_pipeline requires Python 3')
+    def test_exe_pipeline(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        self.assertEqual((0, '2\n', [0, 0, 0]), baseutils.exe_pipeline(['seq 1 10', ['grep', '-c', '1'], 'cat']))
+        self.assertEqual((0, 'b\na\n', [0, 0]), baseutils.exe_pipeline(['cat', 'sort -r'], stdin='a\nb\n'))
+        self.assertEqual((0, '1000000\n', [0, 0]), baseutils.exe_pipeline(['head -c 1000000 /dev/zero', 'wc -c']))
+        self.assertEqual((2, 'err\n', [2, 0]), baseutils.exe_pipeline(['echo err >&2; exit 2', 'cat'], raise_exception=False))
+        self.assertEqual((1, '', [3, 1]), baseutils.exe_pipeline(['exit 3', 'false'], raise_exception=False))
+        with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+            with self.assertRaises(Exception) as context:
+                baseutils.exe_pipeline(['echo secret', ['grep', 'nomatch']], obfuscate='secret')
+        self.assertIn('INFO:baseutils.baseutils:Executing: echo *** | grep nomatch', logs.output)
+        self.assertTrue(str(context.exception).endswith('RC: 1. Stage RCs: [0, 1]. Output: '))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with self.assertRaises(OSError):
+                baseutils.exe_pipeline(['cat', 'cat', ['fake_cmd']], stdin='value')
+        self.assertEqual([], [str(warning.message) for warning in caught if 'unclosed' in str(warning.message)])
+        start = time.time()
+        (rc, output, stage_rcs) = baseutils.exe_pipeline(['echo partial; sleep 30', 'cat'], timeout=0.5, raise_exception=False)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual((-15, 'partial\n'), (rc, output))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'assertLogs requires Python 3')
+    def test_redactor(self):
+        redactor = baseutils.Redactor(['he', 'she', 'hers', 'his', 'secret'])
+        self.assertEqual('u*** and *** ***', redactor.redact('ushers and his secret'))
+        stream = redactor.stream()
+        self.assertEqual('a ', stream.feed('a se'))
+        self.assertEqual('', stream.feed('cr'))
+        self.assertEqual('*** b', stream.feed('et b') + stream.flush())
+        redactor = baseutils.Redactor(['secret{i}x'.format(i=i) for i in range(1000)], replacement='<redacted>')
+        self.assertEqual('a <redacted> <redacted> secret1000x', redactor.redact('a secret12x secret999x secret1000x'))
+        logger = logging.getLogger('test_redactor')
+        with self.assertLogs(logger) as logs:
+            logs_handler = logger.handlers[-1]
+            logs_handler.addFilter(baseutils.RedactingFilter(redactor))
+            logger.info('token=%s', 'secret42x')
+        self.assertEqual(['INFO:test_redactor:token=<redacted>'], logs.output)
+        output = io.StringIO()
+        handler = logging.StreamHandler(output)
+        handler.addFilter(baseutils.RedactingFilter(redactor))
+        logger.addHandler(handler)
+        try:
+            try:
+                raise Exception('failed with secret7x')
+            except Exception:
+                logger.exception('error for %s', 'secret8x')
+        finally:
+            logger.removeHandler(handler)
+        self.assertIn('error for <redacted>\n', output.getvalue())
+        self.assertIn('Exception: failed with <redacted>\n', output.getvalue())
+        self.assertNotIn('secret', output.getvalue())
+        if os.name != 'nt':
+            redactor = baseutils.Redactor(['hunter2', 'swordfish'])
+            with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                with self.assertRaises(Exception) as context:
+                    baseutils.exe_cmd('echo hunter2; echo swordfish >&2; echo hunter2; exit 1', redact=redactor, read_size=3)
+            self.assertIn('INFO:baseutils.baseutils:Executing: echo ***; echo *** >&2; echo ***; exit 1', logs.output)
+            self.assertIn('INFO:baseutils.baseutils:Command output: ***\n***\n***\n', logs.output)
+            self.assertTrue(str(context.exception).endswith('Output: ***\n***\n***\n'))
+            self.assertEqual(['***\n', 'x***\n'], list(baseutils.iter_cmd('echo hunter2; echo xswordfish', redact=redactor)))
+            self.assertEqual((0, '***\n', '***\n'), baseutils.exe_cmd('echo hunter2; echo swordfish >&2', redact=redactor, split_stderr=True))
+            with baseutils.ShellSession() as session:
+                self.assertEqual((0, '***\nx***\n'), session.exe_cmd('echo hunter2; echo xswordfish', redact=redactor))
+            if sys.version_info >= (3, 7):
+                import asyncio
+                self.assertEqual((0, '***\nx***\n'), asyncio.run(baseutils.exe_cmd_async('echo hunter2; echo xswordfish', redact=redactor, read_size=3)))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'split_stderr and assertLogs require Python 3')
+    def test_record_replay_commands(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        tmpdir = tempfile.mkdtemp()
+        # Output longer than iter_cmd and iter_cmd_json keep for error messages is still recorded in full
+        lines = ['{i}\n'.format(i=i) for i in range(1, 101)]
+        items = list(range(5000))
+        json_cmd = 'seq -s , 0 4999 | sed "s/.*/[&]/"'
+        try:
+            for fixture in (os.path.join(tmpdir, 'fixture.jsonl'), os.path.join(tmpdir, 'fixture.jsonl.gz')):
+                runs = os.path.join(tmpdir, 'runs')
+                with baseutils.record_commands(fixture):
+                    self.assertEqual((0, '1\n'), baseutils.exe_cmd('echo run >> {runs}; wc -l < {runs}'.format(runs=runs)))
+                    self.assertEqual((0, '2\n'), baseutils.exe_cmd('echo run >> {runs}; wc -l < {runs}'.format(runs=runs)))
+                    self.assertEqual((0, 'input'), baseutils.exe_cmd('cat', stdin='input'))
+                    self.assertEqual((3, 'out\n', 'err\n'), baseutils.exe_cmd('echo out; echo err >&2; exit 3', split_stderr=True, raise_exception=False))
+                    self.assertEqual(['a\n', 'b\n'], list(baseutils.iter_cmd('printf "a\nb\n"')))
+                    self.assertEqual(lines, list(baseutils.iter_cmd('seq 1 100')))
+                    self.assertEqual(items, list(baseutils.iter_cmd_json(json_cmd, path=None)))
+                    self.assertEqual((0, tmpdir + '\n'), baseutils.exe_cmd('pwd', working_dir=tmpdir))
+                    self.assertEqual((3, 'out\n', 'err\n'), baseutils.exe_cmd('echo out; echo err >&2; exit 3', split_stderr=True, raise_exception=False))
+                    with self.assertRaises(OSError):
+                        baseutils.exe_cmd(['baseutils-missing-command'])
+                    with self.assertRaises(Exception):
+                        baseutils.exe_pipeline(['echo secret', ['grep', 'nomatch']], obfuscate='secret')
+                os.remove(runs)
+                with baseutils.replay_commands(fixture):
+                    self.assertEqual((0, '1\n'), baseutils.exe_cmd('echo run >> {runs}; wc -l < {runs}'.format(runs=runs)))
+                    self.assertEqual((0, '2\n'), baseutils.exe_cmd('echo run >> {runs}; wc -l < {runs}'.format(runs=runs)))
+                    self.assertEqual((0, 'input'), baseutils.exe_cmd('cat', stdin='input'))
+                    self.assertEqual((3, 'out\n', 'err\n'), baseutils.exe_cmd('echo out; echo err >&2; exit 3', split_stderr=True, raise_exception=False))
+                    self.assertEqual(['a\n', 'b\n'], list(baseutils.iter_cmd('printf "a\nb\n"')))
+                    self.assertEqual(lines, list(baseutils.iter_cmd('seq 1 100')))
+                    self.assertEqual(items, list(baseutils.iter_cmd_json(json_cmd, path=None)))
+                    with self.assertRaises(Exception) as context:
+                        baseutils.exe_cmd('pwd')
+                    self.assertIn('No recorded result to replay for command: pwd', str(context.exception))
+                    with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+                        self.assertEqual((0, tmpdir + '\n'), baseutils.exe_cmd('pwd', working_dir=tmpdir))
+                    self.assertIn('INFO:baseutils.baseutils:Replaying: pwd', logs.output)
+                    self.assertFalse([line for line in logs.output if 'Executing' in line])
+                    with self.assertRaises(OSError):
+                        baseutils.exe_cmd(['baseutils-missing-command'])
+                    with self.assertRaises(Exception) as context:
+                        baseutils.exe_pipeline(['echo secret', ['grep', 'nomatch']], obfuscate='secret')
+                    self.assertIn('RC: 1. Stage RCs: [0, 1]. Output: ', str(context.exception))
+                    with self.assertRaises(Exception) as context:
+                        baseutils.exe_cmd('echo out; echo err >&2; exit 3', raise_exception=False)
+                    self.assertIn('recorded with split_stderr=True and cannot be replayed with split_stderr=False', str(context.exception))
+                    with self.assertRaises(Exception) as context:
+                        baseutils.exe_cmd('cat', stdin='other input')
+                    self.assertIn('No recorded result to replay for command: cat', str(context.exception))
+                self.assertFalse(os.path.exists(runs))
+                opener = gzip.open if fixture.endswith('.gz') else open
+                with opener(fixture, 'rb') as f:
+                    entries = [json.loads(line.decode('utf-8')) for line in f]
+                self.assertEqual('echo *** | grep nomatch', entries[-1]['cmd'])
+            with patch.dict(os.environ, {'BASEUTILS_REPLAY_COMMANDS': fixture}):
+                self.assertEqual((0, 'input'), baseutils.exe_cmd('cat', stdin='input'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'cpu_affinity and shutil.which require Python 3')
+    def test_exe_cmd_limits(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        cmd = 'ulimit -n; ulimit -t; ulimit -v; nice; grep Cpus_allowed_list /proc/self/status'
+        expected = (0, '256\n30\n2097152\n5\nCpus_allowed_list:\t0\n')
+        self.assertEqual(expected, baseutils.exe_cmd(cmd, rlimits={'NOFILE': 256, 'cpu': (30, 60), 'RLIMIT_AS': 2 * 1024 ** 3}, nice=5, cpu_affinity={0}))
+        self.assertEqual((0, '5\n', [0, 0]), baseutils.exe_pipeline(['nice', 'cat'], nice=5))
+        baseutils.start_spawn_server()
+        try:
+            self.assertEqual(expected, baseutils.exe_cmd(cmd, rlimits={'NOFILE': 256, 'cpu': (30, 60), 'RLIMIT_AS': 2 * 1024 ** 3}, nice=5, cpu_affinity={0}))
+        finally:
+            baseutils.stop_spawn_server()
+        if shutil.which('ionice'):
+            self.assertEqual((0, 'idle\n'), baseutils.exe_cmd('ionice -p $$', ionice='idle'))
+            self.assertEqual((0, 'best-effort: prio 7\n'), baseutils.exe_cmd('ionice -p $$', ionice=('best-effort', 7)))
+        with self.assertRaises(Exception):
+            baseutils.exe_cmd('true', rlimits={'FAKE': 1})
+        with self.assertRaises(Exception):
+            baseutils.exe_cmd('true', ionice='fake')
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'Popen.wait with a timeout requires Python 3')
+    def test_running_commands(self):
+        # This is nix-specific and will not work on windows
+        if os.name == 'nt':
+            return
+        stream = baseutils.iter_cmd('echo started; sleep 30', log_tag='tag')
+        for line in stream:
+            running = baseutils.running_commands()
+            self.assertEqual(['echo started; sleep 30'], [command.cmd for command in running])
+            self.assertGreaterEqual(running[0].age, 0)
+            break
+        self.assertEqual([], baseutils.running_commands())
+        self.assertEqual(-15, stream.rc)
+        start = time.time()
+        with self.assertRaises(Exception):
+            with baseutils.timeout(seconds=1):
+                baseutils.exe_cmd('sleep 30')
+        self.assertLess(time.time() - start, 10)
+        start = time.time()
+        timer = threading.Timer(0.5, baseutils.terminate_running_commands, kwargs={'grace_period': 5})
+        timer.start()
+        self.assertEqual(-15, baseutils.exe_cmd('sleep 30; echo done', raise_exception=False)[0])
+        timer.join()
+        self.assertLess(time.time() - start, 10)
+        script = ('import baseutils, sys\n'
+                  'baseutils.install_child_cleanup(grace_period=1)\n'
+                  'for line in baseutils.iter_cmd("echo $$; exec sleep 30", log_level=None):\n'
+                  '    sys.stdout.write(line)\n'
+                  '    sys.stdout.flush()\n')
+        with baseutils.baseutils._running_children_lock:
+            self.assertEqual(0, baseutils.terminate_running_commands(grace_period=0))  # as from a signal handler interrupting the registry
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGHUP)}
+        try:
+            with patch('atexit.register') as register, patch.object(baseutils.baseutils, '_child_cleanup_grace_period', None):
+                baseutils.install_child_cleanup(grace_period=1)
+                baseutils.install_child_cleanup(grace_period=2)
+                self.assertEqual(1, register.call_count)
+                self.assertEqual((2, handlers[signal.SIGTERM]), signal.getsignal(signal.SIGTERM).args)
+        finally:
+            for (signum, handler) in handlers.items():
+                signal.signal(signum, handler)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        p = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, env=env)
+        child_pid = int(p.stdout.readline())
+        p.terminate()
+        self.assertEqual(-15, p.wait(timeout=10))
+        p.stdout.close()
+        time.sleep(0.5)
+        try:
+            with open('/proc/{pid}/stat'.format(pid=child_pid)) as f:
+                self.assertEqual('Z', f.read().rsplit(')', 1)[1].split()[0])  # exited, waiting to be reaped
+        except IOError:
+            pass  # exited and reaped
+        # A listed process is only killed if its pid has not been reused by another process since
+        p = subprocess.Popen(['sleep', '30'])
+        try:
+            listed = baseutils.baseutils._listed_processes([p.pid])
+            baseutils.baseutils._kill_listed_processes([(p.pid, listed[0][1] - 1)])
+            time.sleep(0.2)
+            self.assertIsNone(p.poll())
+            baseutils.baseutils._kill_listed_processes(listed)
+            self.assertEqual(-9, p.wait(timeout=10))
+        finally:
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+
+    def test_iter_cmd_json(self):
+        script = 'import json, sys; sys.stdout.write(json.dumps({"kind": "List", "metadata": {"x": [1]}, "items": [{"name": str(i)} for i in range(1000)]}, indent=1))'
+        self.assertEqual([{'name': str(i)} for i in range(1000)], list(baseutils.iter_cmd_json([sys.executable, '-c', script])))
+        script = 'import sys; sys.stdout.write("{\\"data\\": {\\"list\\": [1, 23, \\"a\\"]}}")'
+        self.assertEqual([1, 23, 'a'], list(baseutils.iter_cmd_json([sys.executable, '-c', script], path='data.list')))
+        script = 'import sys; sys.stdout.write("[]")'
+        self.assertEqual([], list(baseutils.iter_cmd_json([sys.executable, '-c', script], path=None)))
+        script = 'import sys; sys.stdout.write("{\\"a\\": 1}\\n{\\"a\\": [2]}\\n 3")'
+        self.assertEqual([{'a': 1}, {'a': [2]}, 3], list(baseutils.iter_cmd_json([sys.executable, '-c', script], json_lines=True)))
+        script = 'import sys; sys.stdout.write("{\\"items\\": [1, 2")'
+        with self.assertRaises(ValueError):
+            list(baseutils.iter_cmd_json([sys.executable, '-c', script]))
+        script = 'import sys; sys.stdout.write("{\\"kind\\": \\"List\\"}")'
+        with self.assertRaises(ValueError):
+            list(baseutils.iter_cmd_json([sys.executable, '-c', script]))
+        script = 'import sys; sys.stdout.write("{\\"items\\": [1, 2], \\"kind\\": \\"List\\"}"); sys.exit(3)'
+        items = []
+        with self.assertRaises(Exception) as context:
+            for item in baseutils.iter_cmd_json([sys.executable, '-c', script], read_size=4):
+                items.append(item)
+        self.assertEqual([1, 2], items)
+        self.assertIn('RC: 3', str(context.exception))
+        self.assertEqual([1, 2], list(baseutils.iter_cmd_json([sys.executable, '-c', script], raise_exception=False)))
+        script = 'import sys; sys.stdout.write("error: not found"); sys.exit(1)'
+        with self.assertRaises(Exception) as context:
+            list(baseutils.iter_cmd_json([sys.executable, '-c', script]))
+        self.assertIn('error: not found', str(context.exception))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'exe_cmds requires Python 3')
+    def test_exe_cmds(self):
+        self.assertEqual([(0, '{i}\n'.format(i=i)) for i in range(20)], baseutils.exe_cmds(['echo {i}'.format(i=i) for i in range(20)], max_workers=5))
+        with self.assertLogs('baseutils.baseutils', level=logging.INFO) as logs:
+            results = baseutils.exe_cmds({'first': 'echo one', 'second': 'echo two'}, stream_log=True)
+        self.assertEqual([(0, 'one\n'), (0, 'two\n')], results)
+        self.assertIn('INFO:baseutils.baseutils:[first] one', logs.output)
+        self.assertIn('INFO:baseutils.baseutils:[second] two', logs.output)
+        if os.name != 'nt':
+            start = time.time()
+            baseutils.exe_cmds(['sleep 0.5'] * 10, max_workers=10)
+            self.assertLess(time.time() - start, 4)
+            self.assertEqual([(0, ''), (1, '')], baseutils.exe_cmds(['exit 0', 'exit 1'], raise_exception=False))
+            tmpdir = tempfile.mkdtemp()
+            try:
+                with self.assertRaises(Exception) as context:
+                    baseutils.exe_cmds(['exit 1', 'sleep 1', 'touch skipped'], max_workers=2, working_dir=tmpdir)
+                self.assertTrue(str(context.exception).startswith('[0] Error executing command: exit 1.'))
+                self.assertFalse(os.path.exists(os.path.join(tmpdir, 'skipped')))
+            finally:
+                shutil.rmtree(tmpdir)
+            with self.assertRaises(Exception) as context:
+                baseutils.exe_cmds({'a': 'exit 1', 'b': 'exit 0', 'c': 'exit 2'}, fail_fast=False)
+            self.assertTrue(str(context.exception).startswith('2 of 3 commands failed:\n[a] Error executing command: exit 1.'))
+
+    def test_iter_cmd(self):
+        stream = baseutils.iter_cmd('echo line1&& echo line2')
+        self.assertIsNone(stream.rc)
+        self.assertEqual(['line1', 'line2'], [line.rstrip() for line in stream])
+        self.assertEqual(0, stream.rc)
+        if os.name != 'nt':
+            stream = baseutils.iter_cmd('seq 1 100; exit 3', raise_exception=False, read_size=baseutils.DEFAULT_READ_SIZE)
+            self.assertEqual('\n'.join(str(i) for i in range(1, 101)) + '\n', ''.join(stream))
+            self.assertEqual(3, stream.rc)
+            with self.assertRaises(Exception) as context:
+                for line in baseutils.iter_cmd('seq 1 100; exit 3'):
+                    pass
+            self.assertTrue(str(context.exception).endswith('Output: ' + ''.join('{i}\n'.format(i=i) for i in range(81, 101))))
+            stream = baseutils.iter_cmd('seq 1 100000')
+            for line in stream:
+                break
+            self.assertIsNotNone(stream.rc)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'asyncio.run requires Python 3.7')
+    def test_exe_cmd_async(self):
+        import asyncio
+        self.assertEqual((0, 'value\n'), asyncio.run(baseutils.exe_cmd_async('echo value')))
+        results = asyncio.run(baseutils.exe_cmds_async(['echo {i}'.format(i=i) for i in range(20)], max_concurrency=5))
+        self.assertEqual([(0, '{i}\n'.format(i=i)) for i in range(20)], results)
+        self.assertEqual((0, 'value\n'), asyncio.run(baseutils.exe_cmd_async([sys.executable, '-c', 'print("value")'])))
+        if os.name != 'nt':
+            self.assertEqual((0, 'value'), asyncio.run(baseutils.exe_cmd_async('cat', stdin='value')))
+            self.assertEqual((3, 'value\n'), asyncio.run(baseutils.exe_cmd_async('echo value; exit 3', raise_exception=False)))
+            with self.assertRaises(Exception) as context:
+                asyncio.run(baseutils.exe_cmd_async('echo secret; exit 3', obfuscate='secret'))
+            self.assertTrue(str(context.exception).startswith('Error executing command: echo ***; exit 3. RC: 3.'))
+            results = asyncio.run(baseutils.exe_cmds_async(['exit 0', 'exit 1'], return_exceptions=True))
+            self.assertEqual((0, ''), results[0])
+            self.assertIsInstance(results[1], Exception)
+            start = time.time()
+            asyncio.run(baseutils.exe_cmds_async(['sleep 0.5'] * 20, max_concurrency=20))
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual((0, 'x' * 200000), asyncio.run(baseutils.exe_cmd_async('cat', stdin=io.BytesIO(b'x' * 200000), log_level=None)))
+            with self.assertRaises(ValueError):
+                asyncio.run(baseutils.exe_cmd_async('cat; echo finished', stdin=self._failing_stdin()))
+            start = time.time()
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(baseutils.exe_cmd_async('sleep 30; echo done', stdin=iter([b'input'])), 0.5))
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual([], baseutils.running_commands())
+
     def test_local_lock(self):
         # This is nix-specific and will not work on windows
         if os.name != 'nt':